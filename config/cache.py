@@ -0,0 +1,452 @@
+"""
+Per-view response caching and a two-tier cache backend.
+
+Unlike the site-wide cache middleware, which can't serve logged-in users
+(their responses vary on Cookie), `cache_response` keys responses on the
+user or their role and the headers the view actually depends on.
+
+Expired responses are kept around for a while longer: the first request
+to see one takes a cache lock and renders a fresh response, everyone
+else keeps getting the stale one meanwhile. When there's nothing cached
+at all, requests give the lock holder a moment to fill the cache before
+rendering the response themselves.
+
+`TieredCache` keeps recently used values in process memory in front of a
+shared cache, see its docstring for the configuration.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.cache import patch_vary_headers
+from django.utils.module_loading import import_string
+
+from .metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+# How often waiting requests check if the lock holder cached the response
+POLL_INTERVAL = 0.05
+
+
+def user_key(request):
+    """Cache responses for each user separately"""
+    if not request.user.is_authenticated:
+        return 'anonymous'
+    return f'user:{request.user.pk}'
+
+
+def role_key(request):
+    """Share cached responses between users with the same role"""
+    user = request.user
+    if user.is_superuser:
+        return 'superuser'
+    if user.is_staff:
+        return 'staff'
+    return 'user' if user.is_authenticated else 'anonymous'
+
+
+def acquire_lock(key, timeout, cache_alias='default'):
+    """
+    Take a lock that expires after `timeout` seconds. Returns a token
+    for `release_lock` or None if somebody else holds the lock.
+    """
+    token = uuid.uuid4().hex
+    if caches[cache_alias].add(key, token, timeout=timeout):
+        return token
+    return None
+
+
+def release_lock(key, token, cache_alias='default'):
+    """Release the lock unless it expired and got taken by someone else"""
+    cache = caches[cache_alias]
+    # Not atomic, but the window is much smaller than the lock's lifetime
+    if cache.get(key) == token:
+        cache.delete(key)
+
+
+def response_key(request, key_prefix, per, headers):
+    parts = [
+        request.method,
+        request.build_absolute_uri(),
+        per(request) if per else '',
+        *(request.META.get(
+            'HTTP_' + header.upper().replace('-', '_'), ''
+        ) for header in headers),
+    ]
+    digest = hashlib.md5('\n'.join(parts).encode('utf-8')).hexdigest()
+    return f'response:{key_prefix}:{digest}'
+
+
+def is_cacheable(request, response):
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return False
+    # A page with a CSRF token in it is only good for its user
+    return not request.META.get('CSRF_COOKIE_USED')
+
+
+def cache_response(
+    timeout=None,
+    stale_timeout=None,
+    per=user_key,
+    headers=(),
+    key_prefix='',
+    cache_alias='default',
+):
+    """
+    Cache GET and HEAD responses of the view for `timeout` seconds and
+    then serve them stale for up to `stale_timeout` more seconds while
+    one request renders a fresh one. Both default to the
+    CACHE_RESPONSE_SECONDS and CACHE_RESPONSE_STALE_SECONDS settings.
+
+    `per` maps a request to the part of the key that depends on who is
+    asking, `user_key` or `role_key`, or None to share responses
+    between everyone. The values of `headers` are added to the key too.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            fresh_for = (
+                settings.CACHE_RESPONSE_SECONDS if timeout is None
+                else timeout
+            )
+            stale_for = (
+                settings.CACHE_RESPONSE_STALE_SECONDS if stale_timeout is None
+                else stale_timeout
+            )
+            cache = caches[cache_alias]
+            key = response_key(
+                request, key_prefix or view.__qualname__, per, headers
+            )
+            lock_key = key + ':lock'
+
+            entry = cache.get(key)
+            if entry is not None and entry[0] > time.time():
+                record_cache('response', 'hit')
+                return entry[1]
+
+            # Fresh or not, the response is built by the lock holder only.
+            # The lock expires along with the wait, in case its holder died
+            wait = settings.CACHE_RESPONSE_WAIT
+            token = acquire_lock(lock_key, wait or 1, cache_alias)
+            if token is None:
+                if entry is not None:
+                    record_cache('response', 'stale')
+                    return entry[1]
+                deadline = time.monotonic() + wait
+                while time.monotonic() < deadline:
+                    time.sleep(POLL_INTERVAL)
+                    entry = cache.get(key)
+                    if entry is not None:
+                        return entry[1]
+                return view(request, *args, **kwargs)
+
+            record_cache('response', 'miss')
+            try:
+                response = view(request, *args, **kwargs)
+                if hasattr(response, 'render') and callable(response.render):
+                    response.render()
+                patch_vary_headers(response, headers)
+                if is_cacheable(request, response):
+                    cache.set(
+                        key,
+                        (time.time() + fresh_for, response),
+                        timeout=fresh_for + stale_for,
+                    )
+            finally:
+                release_lock(lock_key, token, cache_alias)
+            return response
+        return wrapper
+    return decorator
+
+
+class LocalPubSub:
+    """
+    In-process stand-in for `RedisPubSub`, for tests and single process
+    deployments. Instances with the same location share channels.
+    """
+
+    _subscribers = {}
+
+    def __init__(self, location, channel):
+        self.subscribers = self._subscribers.setdefault(
+            (location, channel), []
+        )
+
+    def publish(self, message):
+        for callback in list(self.subscribers):
+            callback(message)
+
+    def subscribe(self, callback, on_connect):
+        self.subscribers.append(callback)
+        on_connect()
+
+
+class RedisPubSub:
+    """
+    Redis pub/sub channel with a listener thread per process. Messages
+    sent while the listener was disconnected are lost, so `on_connect`
+    gets called on every (re)connection to drop whatever they'd have
+    invalidated.
+    """
+
+    # Wait before reconnecting after losing the connection, in seconds
+    RECONNECT_INTERVAL = 1
+
+    def __init__(self, location, channel):
+        import redis
+
+        self.client = redis.Redis.from_url(location)
+        self.channel = channel
+
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+    def subscribe(self, callback, on_connect):
+        thread = threading.Thread(
+            target=self.listen,
+            args=(callback, on_connect),
+            name=f'{__name__}.RedisPubSub',
+            daemon=True,
+        )
+        thread.start()
+
+    def listen(self, callback, on_connect):
+        import redis
+
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        on_connect()
+                    elif message['type'] == 'message':
+                        callback(message['data'])
+            except redis.RedisError:
+                logger.warning('Cache invalidation channel disconnected')
+                on_connect()
+                time.sleep(self.RECONNECT_INTERVAL)
+
+
+class TieredCache(BaseCache):
+    """
+    A bounded LRU cache in process memory (L1) in front of a shared cache
+    (L2). Writes go to L2 and are broadcast over pub/sub, so that other
+    processes drop the key from their L1. Values are also kept in L1 for
+    no longer than LOCAL_TIMEOUT seconds, which bounds the staleness if
+    an invalidation gets lost.
+
+    Use `add`, `incr` and `decr` for anything that needs to be atomic,
+    they always go to L2. Example configuration through the environment:
+
+        CACHE_BACKEND=config.cache.TieredCache
+        CACHE_LOCATION=redis://127.0.0.1:6379/1
+        CACHE_OPTIONS="{'MAX_ENTRIES': 1000, 'LOCAL_TIMEOUT': 30}"
+
+    LOCATION and KEY_PREFIX are passed to L2 together with the options:
+
+        L2_BACKEND - defaults to django_redis.cache.RedisCache
+        L2_OPTIONS - OPTIONS for L2
+        PUBSUB - defaults to config.cache.RedisPubSub
+        PUBSUB_LOCATION - defaults to LOCATION
+        PUBSUB_CHANNEL - defaults to "cache-invalidation:<KEY_PREFIX>"
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 30)
+        self.l2 = import_string(
+            options.get('L2_BACKEND', 'django_redis.cache.RedisCache')
+        )(location, {
+            **params,
+            'OPTIONS': options.get('L2_OPTIONS', {}),
+        })
+        if isinstance(location, str):
+            location = location.split(',')
+        self.pubsub = import_string(
+            options.get('PUBSUB', 'config.cache.RedisPubSub')
+        )(
+            options.get('PUBSUB_LOCATION', location[0]),
+            options.get(
+                'PUBSUB_CHANNEL', f'cache-invalidation:{self.key_prefix}'
+            ),
+        )
+
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribe_lock = threading.Lock()
+        self._generation = 0
+        self._pid = None
+        self._id = uuid.uuid4().hex
+
+    def _subscribe(self):
+        # Listener threads don't survive forking, start one per process
+        if self._pid != os.getpid():
+            with self._subscribe_lock:
+                if self._pid != os.getpid():
+                    self._id = uuid.uuid4().hex
+                    self.pubsub.subscribe(self._on_message, self._clear_local)
+                    self._pid = os.getpid()
+
+    def _on_message(self, message):
+        message = json.loads(message)
+        if message['sender'] == self._id:
+            return
+        with self._lock:
+            self._generation += 1
+            if message['keys'] is None:
+                self._local.clear()
+            for key in message['keys'] or []:
+                self._local.pop(key, None)
+
+    def _clear_local(self):
+        with self._lock:
+            self._generation += 1
+            self._local.clear()
+
+    def _invalidate(self, keys):
+        """Drop the (final) keys here and broadcast it, None for all"""
+        with self._lock:
+            # Keeps fetches that started before this from filling L1
+            self._generation += 1
+            for key in keys or []:
+                self._local.pop(key, None)
+            if keys is None:
+                self._local.clear()
+        self.pubsub.publish(json.dumps({'sender': self._id, 'keys': keys}))
+
+    def _get_local(self, key):
+        with self._lock:
+            if key not in self._local:
+                return None
+            expires, pickled = self._local[key]
+            if expires <= time.time():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+        return pickle.loads(pickled)
+
+    def _set_local(self, key, value, timeout=DEFAULT_TIMEOUT, generation=None):
+        timeout = self.get_backend_timeout(timeout)
+        expires = time.time() + self.local_timeout
+        if timeout is not None:
+            expires = min(expires, timeout)
+        pickled = (expires, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            # Something got invalidated while the value was being fetched
+            if generation is not None and generation != self._generation:
+                return
+            self._local[key] = pickled
+            self._local.move_to_end(key)
+            while len(self._local) > self._max_entries:
+                self._local.popitem(last=False)
+
+    def get(self, key, default=None, version=None):
+        self._subscribe()
+        local_key = self.make_key(key, version=version)
+        value = self._get_local(local_key)
+        if value is not None:
+            record_cache('tiered', 'local')
+            return value[0]
+
+        generation = self._generation
+        value = self.l2.get(key, self._missing_key, version=version)
+        if value is self._missing_key:
+            record_cache('tiered', 'miss')
+            return default
+        record_cache('tiered', 'hit')
+        self._set_local(local_key, (value, ), generation=generation)
+        return value
+
+    def get_many(self, keys, version=None):
+        self._subscribe()
+        found, missing = {}, []
+        for key in keys:
+            value = self._get_local(self.make_key(key, version=version))
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value[0]
+
+        if missing:
+            generation = self._generation
+            fetched = self.l2.get_many(missing, version=version)
+            for key, value in fetched.items():
+                self._set_local(
+                    self.make_key(key, version=version),
+                    (value, ),
+                    generation=generation,
+                )
+            found.update(fetched)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._subscribe()
+        self.l2.set(key, value, timeout, version=version)
+        local_key = self.make_key(key, version=version)
+        self._invalidate([local_key])
+        self._set_local(local_key, (value, ), timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._subscribe()
+        added = self.l2.add(key, value, timeout, version=version)
+        if added:
+            local_key = self.make_key(key, version=version)
+            self._invalidate([local_key])
+            self._set_local(local_key, (value, ), timeout)
+        return added
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self._subscribe()
+        failed = self.l2.set_many(data, timeout, version=version)
+        self._invalidate([self.make_key(key, version=version) for key in data])
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._lock:
+            self._local.pop(self.make_key(key, version=version), None)
+        return self.l2.touch(key, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self.l2.incr(key, delta, version=version)
+        self._invalidate([self.make_key(key, version=version)])
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def delete(self, key, version=None):
+        deleted = self.l2.delete(key, version=version)
+        self._invalidate([self.make_key(key, version=version)])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        self.l2.delete_many(keys, version=version)
+        self._invalidate([self.make_key(key, version=version) for key in keys])
+
+    def has_key(self, key, version=None):
+        value = self.get(key, self._missing_key, version=version)
+        return value is not self._missing_key
+
+    def clear(self):
+        self.l2.clear()
+        self._invalidate(None)
+
+    def close(self, **kwargs):
+        self.l2.close(**kwargs)
@@ -5,9 +5,26 @@ For more information, see
 https://docs.celeryproject.org/en/latest/
 """
 
+import hashlib
+import json
+import logging
 import os
 
-from celery import Celery
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from celery import Celery, Task
+from celery.utils import uuid
+
+# Connects the task telemetry signal handlers
+from . import metrics  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+# Caches that other processes don't see, see DedupTask
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
@@ -29,3 +46,75 @@ app.autodiscover_tasks()
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
+
+
+class DedupTask(Task):
+    """
+    Drop calls of the task with the same arguments as one that is queued
+    or running, returning the result of that one instead:
+
+        @app.task(base=DedupTask, dedup_ttl=60)
+        def send_verification(user_id):
+            ...
+
+    The arguments have to be JSON serializable. `dedup_ttl` defaults to
+    TASK_DEDUP_TTL and limits how long a task that never finishes, e.g.
+    because its worker died, blocks the next calls.
+
+    Workers release the calls in the default cache, so it has to be shared
+    with the web processes, like Redis. With caches that only the process
+    itself sees, calls are only deduplicated when tasks run eagerly.
+    """
+
+    dedup_ttl = None
+
+    def dedup_key(self, args, kwargs):
+        arguments = json.dumps(
+            [list(args or ()), kwargs or {}], sort_keys=True, default=str,
+        )
+        digest = hashlib.sha256(arguments.encode()).hexdigest()
+        return f'task-dedup:{self.name}:{digest}'
+
+    def can_dedup(self):
+        local = isinstance(caches['default'], PROCESS_LOCAL_CACHES)
+        return not local or self.app.conf.task_always_eager
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, **options):
+        if not self.can_dedup():
+            return super().apply_async(args, kwargs, task_id, **options)
+        key = self.dedup_key(args, kwargs)
+        task_id = task_id or uuid()
+        ttl = self.dedup_ttl or settings.TASK_DEDUP_TTL
+        if not cache.add(key, task_id, ttl):
+            pending_id = cache.get(key)
+            # Retries are sent again with the same id
+            if pending_id is not None and pending_id != task_id:
+                logger.info('Dropped a duplicate of %s', pending_id)
+                return self.AsyncResult(pending_id)
+            cache.set(key, task_id, ttl)
+        try:
+            return super().apply_async(args, kwargs, task_id, **options)
+        except Exception:
+            cache.delete(key)
+            raise
+
+    def retry(self, args=None, kwargs=None, *retry_args, **options):
+        # Retried with other arguments, the call gets another key
+        request = self.request
+        new_args = args is not None and list(args) != list(request.args or ())
+        new_kwargs = kwargs is not None and kwargs != request.kwargs
+        if new_args or new_kwargs:
+            self.release(request.args, request.kwargs, request.id)
+        return super().retry(args, kwargs, *retry_args, **options)
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        if status != 'RETRY':
+            self.release(args, kwargs, task_id)
+
+    def release(self, args, kwargs, task_id):
+        """Let the next call with the arguments run, if this one holds them"""
+        if not self.can_dedup():
+            return
+        key = self.dedup_key(args, kwargs)
+        if cache.get(key) == task_id:
+            cache.delete(key)
@@ -0,0 +1,92 @@
+"""
+PostgreSQL backend taking connections from a per-process pool instead of
+connecting for every request. Use it with:
+
+    DB_ENGINE=config.db.backends.postgresql
+    DB_CONN_MAX_AGE=0
+
+and the DB_POOL_* settings, see `DATABASES['default']['POOL']`.
+"""
+
+import os
+import threading
+
+from django.db.backends.postgresql import base
+
+import psycopg2.extensions
+
+from ...pool import ConnectionPool
+
+_lock = threading.Lock()
+_pools = {}
+
+
+def ping(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    if not connection.autocommit:
+        connection.rollback()
+
+
+def get_pool(alias, connect, options):
+    # Forked processes can't share the connections of their parent
+    key = (alias, os.getpid())
+    with _lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                connect,
+                min_size=options.get('MIN_SIZE', 0),
+                max_size=options.get('MAX_SIZE', 10),
+                timeout=options.get('TIMEOUT', 10),
+                max_idle=options.get('MAX_IDLE', 300),
+                ping=ping if options.get('PRE_PING', True) else None,
+            )
+        return _pools[key]
+
+
+def pool_status():
+    """Status of the pools in this process by database alias"""
+    with _lock:
+        pools = {
+            alias: pool for (alias, pid), pool in _pools.items()
+            if pid == os.getpid()
+        }
+    return {alias: pool.status() for alias, pool in pools.items()}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    @property
+    def pool(self):
+        return get_pool(
+            self.alias,
+            lambda: super(DatabaseWrapper, self).get_new_connection(
+                self.get_connection_params()
+            ),
+            self.settings_dict.get('POOL', {}),
+        )
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.checkout()
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        pool, connection = self.pool, self.connection
+        if self.in_atomic_block:
+            # Django keeps using the connection until the block exits
+            pool.discard(connection)
+            return
+        try:
+            idle = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            if connection.closed:
+                raise psycopg2.InterfaceError('connection already closed')
+            if connection.info.transaction_status != idle:
+                connection.rollback()
+        except psycopg2.Error:
+            pool.discard(connection)
+        else:
+            pool.checkin(connection)
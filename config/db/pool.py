@@ -0,0 +1,165 @@
+"""
+A thread-safe database connection pool, see `ConnectionPool`.
+"""
+
+import threading
+import time
+from collections import deque
+
+from django.db.utils import OperationalError
+
+
+class PoolTimeout(OperationalError):
+    """No connection became available within the checkout timeout"""
+
+
+class ConnectionPool:
+    """
+    Keep up to `max_size` connections made by `connect()` open for reuse.
+
+    Checking a connection out waits up to `timeout` seconds for one to
+    become available. Idle connections are pinged with `ping(connection)`
+    before being handed out and closed with `close(connection)` after
+    `max_idle` seconds, apart from the `min_size` most recently used:
+
+    >>> pool = ConnectionPool(object, max_size=1, timeout=0)
+    >>> connection = pool.checkout()
+    >>> pool.checkout()
+    Traceback (most recent call last):
+        ...
+    config.db.pool.PoolTimeout: No connection available in 0 seconds.
+    >>> pool.checkin(connection)
+    >>> pool.checkout() is connection
+    True
+    """
+
+    def __init__(
+        self,
+        connect,
+        min_size=0,
+        max_size=10,
+        timeout=10,
+        max_idle=300,
+        ping=None,
+        close=lambda connection: connection.close(),
+    ):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping = ping
+        self.close = close
+
+        self._idle = deque()  # (connection, checked in at), oldest first
+        self._size = 0
+        self._condition = threading.Condition()
+        self.stats = {
+            'connections_created': 0,
+            'connections_closed': 0,
+            'checkouts': 0,
+            'checkout_timeouts': 0,
+            'checkout_wait_seconds': 0.0,
+            'failed_pings': 0,
+        }
+
+    def status(self):
+        """Current pool state, together with the counters in `stats`"""
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                **self.stats,
+            }
+
+    def checkout(self):
+        started = time.monotonic()
+        # Also on checkout, so that a quiet process closes its idle ones
+        with self._condition:
+            expired = self._reap()
+        self._close_all(expired)
+
+        while True:
+            connection = self._reserve(started)
+            if connection is None:
+                try:
+                    connection = self.connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+                with self._condition:
+                    self.stats['connections_created'] += 1
+                break
+            if self.ping is None or self._ping(connection):
+                break
+
+        with self._condition:
+            self.stats['checkouts'] += 1
+            self.stats['checkout_wait_seconds'] += time.monotonic() - started
+        return connection
+
+    def checkin(self, connection):
+        """Return a connection that is in a clean state for reuse"""
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+            expired = self._reap()
+        self._close_all(expired)
+
+    def discard(self, connection):
+        """Close a connection that can't be reused and free its slot"""
+        self._close_all([connection])
+        self._release_slot()
+
+    def _reserve(self, started):
+        """An idle connection, or None after reserving a slot for a new one"""
+        with self._condition:
+            while True:
+                if self._idle:
+                    # The most recently used one, the rest can expire
+                    return self._idle.pop()[0]
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+                remaining = started + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    self.stats['checkout_timeouts'] += 1
+                    raise PoolTimeout(
+                        f'No connection available in {self.timeout} seconds.'
+                    )
+                self._condition.wait(remaining)
+
+    def _release_slot(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _ping(self, connection):
+        try:
+            self.ping(connection)
+            return True
+        except Exception:
+            with self._condition:
+                self.stats['failed_pings'] += 1
+            self.discard(connection)
+            return False
+
+    def _reap(self):
+        """Take connections idle for too long out of the pool"""
+        expired = []
+        deadline = time.monotonic() - self.max_idle
+        while len(self._idle) > self.min_size and self._idle[0][1] < deadline:
+            expired.append(self._idle.popleft()[0])
+            self._size -= 1
+            self._condition.notify()
+        return expired
+
+    def _close_all(self, connections):
+        for connection in connections:
+            try:
+                self.close(connection)
+            except Exception:
+                pass
+            with self._condition:
+                self.stats['connections_closed'] += 1
@@ -0,0 +1,95 @@
+"""
+Send reads to replicas and writes to the primary, with read-your-writes:
+after a write, the rest of the request and the requests of the same
+client within `DB_REPLICA_PIN_SECONDS` read from the primary too.
+"""
+
+import asyncio
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from celery.signals import task_prerun
+
+PIN_COOKIE = 'pin_primary'
+
+# Whether reads go to the primary, set after writes and by the middleware
+pinned = ContextVar('pinned', default=False)
+# Whether the current request wrote, to pin the client for the next ones
+wrote = ContextVar('wrote', default=False)
+
+
+@task_prerun.connect
+def unpin_task(**kwargs):
+    # Tasks don't see the writes of earlier tasks in the worker either
+    pinned.set(False)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if pinned.get() or not settings.DATABASE_REPLICAS:
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        pinned.set(True)
+        wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class PinPrimaryMiddleware:
+    """Keep clients that wrote reading from the primary for a while"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Don't take a thread for async views, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        tokens = self.pin(request)
+        try:
+            return self.process_response(self.get_response(request))
+        finally:
+            self.unpin(tokens)
+
+    async def __acall__(self, request):
+        tokens = self.pin(request)
+        try:
+            return self.process_response(await self.get_response(request))
+        finally:
+            self.unpin(tokens)
+
+    def pin(self, request):
+        return pinned.set(PIN_COOKIE in request.COOKIES), wrote.set(False)
+
+    def unpin(self, tokens):
+        pinned_token, wrote_token = tokens
+        pinned.reset(pinned_token)
+        wrote.reset(wrote_token)
+
+    def process_response(self, response):
+        # Not renewed by the cookie alone, so pins run out
+        if wrote.get() and settings.DATABASE_REPLICAS:
+            response.set_cookie(
+                PIN_COOKIE, '1',
+                max_age=settings.DB_REPLICA_PIN_SECONDS,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
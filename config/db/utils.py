@@ -0,0 +1,26 @@
+"""Database helpers for maintenance tasks"""
+
+import time
+
+from django.db import router
+
+
+def delete_in_batches(queryset, batch_size, pause=0):
+    """
+    Delete the rows of the queryset `batch_size` primary keys at a time,
+    in short statements that don't hold locks on the whole table,
+    sleeping `pause` seconds in between to let replicas catch up.
+    Keys are read from the primary and the queryset's filters checked
+    again on delete, so rows changed meanwhile are kept.
+    Returns the number of deleted rows.
+    """
+    queryset = queryset.using(router.db_for_write(queryset.model))
+    deleted = 0
+    while True:
+        keys = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not keys:
+            return deleted
+        deleted += queryset.filter(pk__in=keys).delete()[0]
+        if len(keys) < batch_size:
+            return deleted
+        time.sleep(pause)
@@ -0,0 +1,126 @@
+"""
+Email backend handing messages over to Celery, so that requests don't
+wait for the mail server. Use it with:
+
+    EMAIL_BACKEND=config.mail.CeleryEmailBackend
+    EMAIL_DELIVERY_BACKEND=django.core.mail.backends.smtp.EmailBackend
+
+Workers send the messages with EMAIL_DELIVERY_BACKEND, keeping a
+connection open between tasks in each thread instead of connecting for
+every message.
+"""
+
+import logging
+import threading
+from smtplib import SMTPRecipientsRefused
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+
+from celery.signals import worker_process_shutdown
+
+logger = logging.getLogger(__name__)
+
+# Connection of each thread, and all of them to close them on shutdown
+_local = threading.local()
+_connections = set()
+_connections_lock = threading.Lock()
+
+
+def serialize_message(message):
+    """
+    Message fields that survive the JSON serializer of Celery. Attached
+    files have to be text.
+    """
+    return {
+        'subject': message.subject,
+        'body': message.body,
+        'from_email': message.from_email,
+        'to': message.to,
+        'cc': message.cc,
+        'bcc': message.bcc,
+        'reply_to': message.reply_to,
+        'headers': message.extra_headers,
+        'alternatives': getattr(message, 'alternatives', []),
+        'attachments': message.attachments,
+        'content_subtype': message.content_subtype,
+    }
+
+
+def deserialize_message(fields, connection=None):
+    fields = dict(fields)
+    content_subtype = fields.pop('content_subtype')
+    message = EmailMultiAlternatives(connection=connection, **{
+        name: [tuple(item) for item in value]
+        if name in ('alternatives', 'attachments') else value
+        for name, value in fields.items()
+    })
+    message.content_subtype = content_subtype
+    return message
+
+
+def get_delivery_connection():
+    """Connection of the delivery backend, kept open by the thread"""
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = get_connection(settings.EMAIL_DELIVERY_BACKEND)
+        _local.connection = connection
+        with _connections_lock:
+            _connections.add(connection)
+    connection.open()
+    return connection
+
+
+def close_delivery_connection():
+    """Close the connection of the thread, to reopen it on the next use"""
+    connection = getattr(_local, 'connection', None)
+    if connection is not None:
+        _local.connection = None
+        with _connections_lock:
+            _connections.discard(connection)
+        connection.close()
+
+
+@worker_process_shutdown.connect
+def close_delivery_connections(**kwargs):
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for connection in connections:
+        connection.close()
+
+
+def deliver_message(fields):
+    """
+    Send a serialized message over the thread's connection, reconnecting
+    once if it fails, as the server may have closed it while idle
+    """
+    try:
+        deserialize_message(fields, get_delivery_connection()).send()
+    except SMTPRecipientsRefused:
+        raise
+    except Exception:
+        logger.info('Reconnecting to deliver emails', exc_info=True)
+        close_delivery_connection()
+        deserialize_message(fields, get_delivery_connection()).send()
+
+
+class CeleryEmailBackend(BaseEmailBackend):
+    """Queue the messages for `config.tasks.send_emails`"""
+
+    def send_messages(self, email_messages):
+        from .tasks import send_emails
+
+        if not email_messages:
+            return 0
+        try:
+            send_emails.delay([
+                serialize_message(message) for message in email_messages
+            ])
+        except Exception:
+            if not self.fail_silently:
+                raise
+            logger.exception('Failed to queue %d emails', len(email_messages))
+            return 0
+        return len(email_messages)
@@ -0,0 +1,274 @@
+"""Load test the API against a fake OAuth provider"""
+
+import json
+import math
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from django.test.testcases import QuietWSGIRequestHandler
+from django.test.utils import (
+    override_settings,
+    setup_databases,
+    teardown_databases,
+)
+
+import requests
+
+PASSWORD = 'Correct-horse-battery-staple'
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of sorted values:
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    >>> percentile([], 50) is None
+    True
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    """
+    Token and user info endpoints of a Facebook-like provider, answering
+    like the fakes in users/tests.py. The code becomes the access token,
+    which becomes the user id.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't delay the body
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = parse_qs(self.rfile.read(length).decode())
+        if self.path == '/token':
+            body = {
+                'expires_in': 3600,
+                'token_type': 'bearer',
+                'access_token': data.get('code', [''])[0],
+            }
+        elif self.path == '/me':
+            subject = self.headers.get('Authorization', '').split()[-1]
+            body = {
+                'id': subject,
+                'first_name': 'John',
+                'last_name': 'Doe',
+                'email': f'{subject}@example.com',
+            }
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        content = json.dumps(body).encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AppRequestHandler(QuietWSGIRequestHandler):
+    disable_nagle_algorithm = True
+
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}'
+
+
+class VirtualUser:
+    """Runs the scenario in a loop, with its own cookies and connections"""
+
+    def __init__(self, number, url):
+        self.number = number
+        self.url = url
+        self.session = requests.Session()
+        self.iteration = 0
+
+    def request(self, method, path, **kwargs):
+        return self.session.request(
+            method, self.url + path, allow_redirects=False, **kwargs
+        )
+
+    def scenario(self):
+        """Requests of an iteration, as (endpoint, expected status, call)"""
+        username = f'bench{self.number}x{self.iteration}'
+        return [
+            ('api-root', HTTPStatus.OK, lambda: self.request('GET', '/api/')),
+            ('auth-root', HTTPStatus.OK, lambda: self.request(
+                'GET', '/api/auth/',
+            )),
+            ('register', HTTPStatus.CREATED, lambda: self.request(
+                'POST', '/api/auth/register/', data={
+                    'username': username,
+                    'email': f'{username}@example.com',
+                    'password': PASSWORD,
+                    'password_confirm': PASSWORD,
+                },
+            )),
+            ('login', HTTPStatus.OK, lambda: self.request(
+                'POST', '/api/auth/login/', data={
+                    'login': f'bench{self.number}',
+                    'password': PASSWORD,
+                },
+            )),
+            ('oauth-provider', HTTPStatus.FOUND, lambda: self.request(
+                'GET', '/api/auth/oauth/provider/facebook/',
+            )),
+            ('oauth-callback', HTTPStatus.OK, lambda: self.request(
+                'GET', '/api/auth/oauth/callback/facebook/', params={
+                    'code': f'bench{self.number}',
+                    'state': self.state,
+                },
+            )),
+        ]
+
+    def run(self, deadline, results):
+        while time.monotonic() < deadline:
+            self.state = None
+            for endpoint, expected, call in self.scenario():
+                if endpoint in ('register', 'login', 'oauth-provider'):
+                    # Start anonymous, as the login endpoints expect
+                    self.session.cookies.clear()
+                started = time.perf_counter()
+                try:
+                    response = call()
+                    ok = response.status_code == expected
+                except requests.RequestException:
+                    response, ok = None, False
+                results[endpoint].append((time.perf_counter() - started, ok))
+
+                if endpoint == 'oauth-provider' and ok:
+                    location = urlparse(response.headers['Location'])
+                    self.state = parse_qs(location.query)['state'][0]
+            self.iteration += 1
+
+
+class Command(BaseCommand):
+    help = (
+        'Serve the app with a fake OAuth provider and a test database, '
+        'drive it with concurrent virtual users and print requests per '
+        'second, latency percentiles in ms and errors by endpoint as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=10,
+            help='Number of concurrent virtual users.',
+        )
+        parser.add_argument(
+            '--duration', type=float, default=10,
+            help='Seconds to run the load for.',
+        )
+        parser.add_argument(
+            '--output',
+            help='File to write the JSON report to instead of stdout.',
+        )
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            for connection in connections.all():
+                if connection.vendor == 'sqlite':
+                    # A file rather than in-memory database, for threads
+                    connection.settings_dict['TEST']['NAME'] = str(
+                        Path(directory) / f'{connection.alias}.sqlite3'
+                    )
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                report = self.benchmark(options['users'], options['duration'])
+            finally:
+                teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            Path(options['output']).write_text(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def benchmark(self, users, duration):
+        provider = ThreadingHTTPServer(('127.0.0.1', 0), FakeProviderHandler)
+        provider_url = start_server(provider)
+
+        with override_settings(
+            ALLOWED_HOSTS=['127.0.0.1'],
+            SECURE_SSL_REDIRECT=False,
+            SESSION_COOKIE_SECURE=False,
+            CSRF_COOKIE_SECURE=False,
+            EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend',
+            OAUTH={'facebook': {
+                'auth_uri': provider_url + '/auth',
+                'client_id': 'benchmark',
+                'client_secret': 'benchmark',
+                'scope': 'email',
+                'token_uri': provider_url + '/token',
+                'userinfo_uri': provider_url + '/me',
+            }},
+        ):
+            for number in range(users):
+                get_user_model().objects.create_user(
+                    f'bench{number}', password=PASSWORD,
+                )
+
+            app = ThreadedWSGIServer(('127.0.0.1', 0), AppRequestHandler)
+            app.set_app(get_wsgi_application())
+            url = start_server(app)
+
+            results = defaultdict(list)
+            deadline = time.monotonic() + duration
+            started = time.monotonic()
+            threads = [
+                threading.Thread(
+                    target=VirtualUser(number, url).run,
+                    args=(deadline, results),
+                )
+                for number in range(users)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started
+
+            app.shutdown()
+            app.server_close()
+        provider.shutdown()
+        provider.server_close()
+
+        endpoints = {}
+        for endpoint, samples in results.items():
+            latencies = sorted(seconds * 1000 for seconds, ok in samples)
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'errors': sum(not ok for seconds, ok in samples),
+                'rps': round(len(samples) / elapsed, 2),
+                **{
+                    f'p{percent}': round(percentile(latencies, percent), 2)
+                    for percent in (50, 95, 99)
+                },
+            }
+        return {
+            'users': users,
+            'duration': round(elapsed, 2),
+            'endpoints': endpoints,
+        }
@@ -0,0 +1,136 @@
+"""Report where the startup time goes: settings blocks and imports"""
+
+import json
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter, so that nothing is imported already. The
+# settings module is executed one block at a time, separated by two blank
+# lines and a comment title, before Django gets to import it
+STARTUP_SCRIPT = '''
+import json, re, sys, time, types
+
+name, path, attribute = sys.argv[1:4]
+settings = sys.modules[name] = types.ModuleType(name)
+settings.__file__ = path
+with open(path, encoding='utf-8') as file:
+    source = file.read()
+
+timings = []
+line = 1
+for block in re.split(r'\\n\\n\\n(?=# )', source):
+    title = block.lstrip('\\n').split('\\n', 1)[0].strip('# "') or 'Header'
+    # Pad with newlines to keep line numbers in tracebacks right
+    code = compile('\\n' * (line - 1) + block, path, 'exec')
+    started = time.perf_counter()
+    exec(code, settings.__dict__)
+    timings.append((f'{title} (line {line})', time.perf_counter() - started))
+    line += block.count('\\n') + 3
+
+import django
+from django.urls import get_resolver
+django.setup()
+getattr(get_resolver(), attribute)
+print('\\n' + json.dumps(timings))
+'''
+
+IMPORTTIME_LINE = re.compile(
+    r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)'
+)
+
+
+def parse_importtime(output):
+    """
+    Parse `python -X importtime` output into (module, self, cumulative)
+    tuples, times in seconds:
+
+    >>> parse_importtime(
+    ...     'import time: self [us] | cumulative | imported package\\n'
+    ...     'import time:       150 |        150 |   django.utils\\n'
+    ...     'import time:      1000 |       1150 | django\\n'
+    ... )
+    [('django.utils', 0.00015, 0.00015), ('django', 0.001, 0.00115)]
+    """
+    return [
+        (match.group(4), int(match.group(1)) / 1e6, int(match.group(2)) / 1e6)
+        for match in map(IMPORTTIME_LINE.match, output.splitlines())
+        if match
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        'Report the time it takes to execute each settings block and to '
+        'import each module while setting up Django and loading the '
+        'URLconf, similar to "python -X importtime".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit', type=int, default=30,
+            help='Number of the slowest modules to show.',
+        )
+        parser.add_argument(
+            '--sort', choices=['self', 'cumulative'], default='cumulative',
+            help='Sort modules by their own or cumulative import time.',
+        )
+        parser.add_argument(
+            '--group', action='store_true',
+            help='Sum self times by top-level package.',
+        )
+        parser.add_argument(
+            '--resolve', action='store_true',
+            help='Populate the URL resolver too, importing lazy app urls.',
+        )
+
+    def handle(self, *args, **options):
+        process = subprocess.run(
+            [
+                sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT,
+                settings.SETTINGS_MODULE,
+                sys.modules[settings.SETTINGS_MODULE].__file__,
+                'reverse_dict' if options['resolve'] else 'url_patterns',
+            ],
+            cwd=settings.BASE_DIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if process.returncode != 0:
+            raise CommandError(process.stderr.splitlines()[-1])
+        imports = parse_importtime(process.stderr)
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Settings blocks:'))
+        timings = json.loads(process.stdout.splitlines()[-1])
+        for title, seconds in timings:
+            self.stdout.write(f'{seconds * 1000:10.2f} ms  {title}')
+        total = sum(seconds for title, seconds in timings)
+        self.stdout.write(f'{total * 1000:10.2f} ms  total')
+
+        if options['group']:
+            packages = defaultdict(float)
+            for module, own, cumulative in imports:
+                packages[module.split('.')[0]] += own
+            imports = [
+                (package, own, own) for package, own in packages.items()
+            ]
+
+        key = 1 if options['sort'] == 'self' or options['group'] else 2
+        imports.sort(key=lambda item: item[key], reverse=True)
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            '\nImports (self, cumulative):'
+        ))
+        for module, own, cumulative in imports[:options['limit']]:
+            self.stdout.write(
+                f'{own * 1000:10.2f} ms {cumulative * 1000:10.2f} ms  {module}'
+            )
+        total = sum(own for module, own, cumulative in imports)
+        self.stdout.write(
+            f'{total * 1000:10.2f} ms  total, {len(imports)} entries'
+        )
@@ -1,6 +1,7 @@
 """Run Celery with autoreload for development"""
 
 import os
+import shlex
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
@@ -11,16 +12,69 @@ def tasks_watchdog(sender, **kwargs):
     sender.watch_dir(settings.BASE_DIR, '**/*tasks.py')
 
 
-def restart_celery():
+def worker_command(profile=None, beat=False):
+    """
+    Celery worker command line for a profile of WORKER_PROFILES, or for
+    a worker consuming every queue if no profile is given:
+
+    >>> worker_command(beat=True)
+    'celery -A config worker -l INFO -Q default,io -B'
+    """
+    args = ['celery', '-A', 'config', 'worker', '-l', 'INFO']
+    if profile is None:
+        queues = {
+            queue
+            for options in settings.WORKER_PROFILES.values()
+            for queue in options['queues']
+        }
+        args += ['-Q', ','.join(sorted(queues))]
+    else:
+        options = settings.WORKER_PROFILES[profile]
+        args += [
+            '-Q', ','.join(options['queues']),
+            '-P', options['pool'],
+            '--prefetch-multiplier', str(options['prefetch_multiplier']),
+        ]
+        if options['concurrency']:
+            args += ['-c', str(options['concurrency'])]
+    if beat:
+        args += ['-B']
+    return ' '.join(map(shlex.quote, args))
+
+
+def restart_celery(command):
     if os.name == 'nt':
         os.system('taskkill /im celery.exe /f')
     else:
-        os.system('pkill celery')
-    os.system('celery -A config worker -c 1 -l INFO')
+        # Leave the workers of other profiles running
+        os.system(f'pkill -f {shlex.quote(command)}')
+    os.system(command)
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profile', choices=list(settings.WORKER_PROFILES),
+            help='Consume the queues of a WORKER_PROFILES profile only, '
+                 'with its pool, concurrency and prefetch settings.',
+        )
+        parser.add_argument(
+            '--beat', action='store_true',
+            help='Run the beat scheduler too, the default without profile.',
+        )
+        parser.add_argument(
+            '--noreload', action='store_false', dest='use_reloader',
+            help='Run the worker in place of this process, without '
+                 'autoreload.',
+        )
+
     def handle(self, *args, **options):
-        self.stdout.write('Starting celery worker with autoreload...')
+        profile = options['profile']
+        command = worker_command(profile, options['beat'] or profile is None)
+        if not options['use_reloader']:
+            args = shlex.split(command)
+            os.execvp(args[0], args)
+
+        self.stdout.write(f'Starting "{command}" with autoreload...')
         autoreload.autoreload_started.connect(tasks_watchdog)
-        autoreload.run_with_reloader(restart_celery)
+        autoreload.run_with_reloader(restart_celery, command)
@@ -0,0 +1,427 @@
+"""
+Prometheus metrics for the request hot path: latency, database queries,
+cache lookups and outbound HTTP calls by view, and the state of the
+database connection pools, served by `config.views.metrics`. Celery
+workers record task wait and run times, retries and failures, served on
+WORKER_METRICS_PORT if set.
+
+Gunicorn workers and prefork Celery workers are separate processes, so
+set the PROMETHEUS_MULTIPROC_DIR environment variable to an empty
+directory shared by the processes, to aggregate the metrics of all of
+them. Connection pools are still those of the process serving the
+metrics.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from celery.signals import (
+    before_task_publish,
+    task_failure,
+    task_postrun,
+    task_prerun,
+    task_retry,
+    worker_init,
+)
+from kombu.exceptions import ChannelError, OperationalError
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float('inf'))
+
+# Cache backend methods counted as calls, see install_cache_counters
+CACHE_OPERATIONS = (
+    'add', 'get', 'set', 'touch', 'delete', 'get_many', 'has_key', 'incr',
+    'decr', 'set_many', 'delete_many', 'clear',
+)
+
+REQUEST_SECONDS = Histogram(
+    'django_request_seconds', 'Request latency by view', ['view'],
+)
+REQUEST_QUERIES = Histogram(
+    'django_request_db_queries', 'Database queries per request by view',
+    ['view'], buckets=COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    'django_request_db_seconds', 'Database time per request by view',
+    ['view'],
+)
+REQUEST_CACHE_CALLS = Histogram(
+    'django_request_cache_calls', 'Cache calls per request by view',
+    ['view'], buckets=COUNT_BUCKETS,
+)
+REQUEST_CACHE_SECONDS = Histogram(
+    'django_request_cache_seconds', 'Cache time per request by view',
+    ['view'],
+)
+REQUEST_CACHE_LOOKUPS = Counter(
+    'django_request_cache_lookups', 'Cache gets by view and result',
+    ['view', 'result'],
+)
+REQUEST_HTTP_SECONDS = Histogram(
+    'django_request_http_seconds', 'Outbound HTTP time per request by view',
+    ['view'],
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups', 'Cache lookups by cache and result', ['cache', 'result'],
+)
+HTTP_SECONDS = Histogram(
+    'oauth_http_seconds', 'OAuth provider request latency',
+    ['provider', 'status'],
+)
+TASK_WAIT_SECONDS = Histogram(
+    'celery_task_wait_seconds', 'Time tasks waited in the queue by task',
+    ['task'],
+)
+TASK_SECONDS = Histogram(
+    'celery_task_seconds', 'Task run time by task and state',
+    ['task', 'state'],
+)
+TASK_RETRIES = Counter('celery_task_retries', 'Task retries by task', ['task'])
+TASK_FAILURES = Counter(
+    'celery_task_failures', 'Task failures by task', ['task'],
+)
+
+# Resources used by the current request, see MetricsMiddleware
+_usage = ContextVar('usage', default=None)
+
+# Stands in for the default of cache gets, to tell misses from hits
+_missing = object()
+
+
+# Start times of the tasks running in this process by task id
+_task_started = {}
+
+
+class QueueDepthCollector:
+    """Messages waiting in the broker by queue, read when collected"""
+
+    def describe(self):
+        # Registering calls collect() otherwise, asking the broker
+        return [self.metric()]
+
+    def metric(self):
+        return GaugeMetricFamily(
+            'celery_queue_depth', 'Messages waiting by queue',
+            labels=['queue'],
+        )
+
+    def collect(self):
+        from .celery import app
+
+        queues = {settings.CELERY_TASK_DEFAULT_QUEUE} | {
+            queue
+            for options in settings.WORKER_PROFILES.values()
+            for queue in options['queues']
+        }
+        depth = self.metric()
+        try:
+            with app.connection_for_read() as connection:
+                # Don't hold the scrape up retrying an unavailable broker
+                connection.ensure_connection(
+                    max_retries=1, interval_start=0, timeout=1,
+                )
+                channel = connection.default_channel
+                for queue in sorted(queues):
+                    try:
+                        count = channel.queue_declare(
+                            queue, passive=True
+                        ).message_count
+                    except ChannelError:
+                        count = 0  # Not declared yet, nothing was sent
+                    depth.add_metric([queue], count)
+        except OperationalError:
+            logger.warning('Broker unavailable, skipping queue depths')
+        yield depth
+
+
+QUEUE_DEPTH = QueueDepthCollector()
+
+
+class PoolCollector:
+    """
+    Connections of the pools of `config.db.backends.postgresql` by
+    database, in the process serving the metrics
+    """
+
+    gauges = {
+        'size': 'Open pooled connections',
+        'idle': 'Idle pooled connections',
+        'in_use': 'Checked out pooled connections',
+    }
+    counters = {
+        'connections_created': 'Pooled connections opened',
+        'connections_closed': 'Pooled connections closed',
+        'checkouts': 'Pooled connection checkouts',
+        'checkout_timeouts': 'Pooled connection checkouts that timed out',
+        'checkout_wait_seconds': 'Time spent checking connections out',
+        'failed_pings': 'Pooled connections that failed the pre-ping',
+    }
+
+    def describe(self):
+        return list(self.metrics().values())
+
+    def metrics(self):
+        metrics = {
+            name: GaugeMetricFamily(
+                f'db_pool_{name}', documentation, labels=['database'],
+            )
+            for name, documentation in self.gauges.items()
+        }
+        metrics.update({
+            name: CounterMetricFamily(
+                f'db_pool_{name}', documentation, labels=['database'],
+            )
+            for name, documentation in self.counters.items()
+        })
+        return metrics
+
+    def collect(self):
+        from .db.backends.postgresql.base import pool_status
+
+        metrics = self.metrics()
+        for alias, status in pool_status().items():
+            for name, metric in metrics.items():
+                metric.add_metric([alias], status[name])
+        yield from metrics.values()
+
+
+DB_POOLS = PoolCollector()
+
+
+def get_registry():
+    """The registry to collect, aggregating processes in multiprocess mode"""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(QUEUE_DEPTH)
+    registry.register(DB_POOLS)
+    return registry
+
+
+def record_cache(cache, result):
+    """Count a lookup in `cache` by `result`, e.g. "hit" or "miss" """
+    CACHE_LOOKUPS.labels(cache, result).inc()
+
+
+def record_http(provider, status, seconds):
+    HTTP_SECONDS.labels(provider, status).observe(seconds)
+    usage = _usage.get()
+    if usage is not None:
+        usage['http_seconds'] += seconds
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unresolved'
+
+
+def count_query(execute, sql, params, many, context):
+    usage = _usage.get()
+    if usage is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        usage['queries'] += 1
+        usage['db_seconds'] += time.perf_counter() - started
+
+
+def count_cache_call(method):
+    @wraps(method)
+    def wrapper(cache, *args, **kwargs):
+        usage = _usage.get()
+        # Count get_many once, even if it's implemented with get
+        if usage is None or usage['cache_depth']:
+            return method(cache, *args, **kwargs)
+        usage['cache_depth'] += 1
+        started = time.perf_counter()
+        try:
+            return method(cache, *args, **kwargs)
+        finally:
+            usage['cache_depth'] -= 1
+            usage['cache_calls'] += 1
+            usage['cache_seconds'] += time.perf_counter() - started
+
+    wrapper.counts_cache = True
+    return wrapper
+
+
+def count_cache_get(get):
+    counted_get = count_cache_call(get)
+
+    @wraps(get)
+    def wrapper(cache, key, default=None, *args, **kwargs):
+        usage = _usage.get()
+        if usage is None or usage['cache_depth']:
+            return get(cache, key, default, *args, **kwargs)
+        value = counted_get(cache, key, _missing, *args, **kwargs)
+        if value is _missing:
+            usage['cache_misses'] += 1
+            return default
+        usage['cache_hits'] += 1
+        return value
+
+    wrapper.counts_cache = True
+    return wrapper
+
+
+def install_cache_counters():
+    """
+    Count the calls of the configured cache backends while requests run.
+    Like the query counter, the wrappers stay installed and only count
+    when MetricsMiddleware measures a request.
+    """
+    for alias in settings.CACHES:
+        backend = type(caches[alias])
+        for name in CACHE_OPERATIONS:
+            method = getattr(backend, name)
+            if getattr(method, 'counts_cache', False):
+                continue
+            wrap = count_cache_get if name == 'get' else count_cache_call
+            setattr(backend, name, wrap(method))
+
+
+def new_usage():
+    return {
+        'queries': 0,
+        'db_seconds': 0.0,
+        'cache_calls': 0,
+        'cache_seconds': 0.0,
+        'cache_hits': 0,
+        'cache_misses': 0,
+        'cache_depth': 0,
+        'http_seconds': 0.0,
+    }
+
+
+@receiver(connection_created)
+def install_query_counter(connection, **kwargs):
+    # On every connection rather than per request, as async requests query
+    # from other threads. First, so that execute_wrapper() blocks entered
+    # before the connection was opened remove their own wrappers
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_query)
+
+
+class MetricsMiddleware:
+    """Record the latency and the resources used by each request"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Don't take a thread for async views, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        install_cache_counters()
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        usage = new_usage()
+        token = _usage.set(usage)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _usage.reset(token)
+        self.record(request, usage, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        # Threads running sync code get a copy of the context, sharing usage
+        usage = new_usage()
+        token = _usage.set(usage)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _usage.reset(token)
+        self.record(request, usage, time.perf_counter() - started)
+        return response
+
+    def record(self, request, usage, seconds):
+        view = view_name(request)
+        REQUEST_SECONDS.labels(view).observe(seconds)
+        REQUEST_QUERIES.labels(view).observe(usage['queries'])
+        REQUEST_DB_SECONDS.labels(view).observe(usage['db_seconds'])
+        REQUEST_CACHE_CALLS.labels(view).observe(usage['cache_calls'])
+        REQUEST_CACHE_SECONDS.labels(view).observe(usage['cache_seconds'])
+        REQUEST_CACHE_LOOKUPS.labels(view, 'hit').inc(usage['cache_hits'])
+        REQUEST_CACHE_LOOKUPS.labels(view, 'miss').inc(usage['cache_misses'])
+        REQUEST_HTTP_SECONDS.labels(view).observe(usage['http_seconds'])
+
+
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    REGISTRY.register(QUEUE_DEPTH)
+    REGISTRY.register(DB_POOLS)
+
+
+@before_task_publish.connect
+def stamp_task(headers=None, **kwargs):
+    headers['enqueued_at'] = time.time()
+
+
+@task_prerun.connect
+def task_started(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    enqueued_at = getattr(task.request, 'enqueued_at', None)
+    if enqueued_at is None:
+        return  # Run eagerly or sent by an older client
+    # Don't count the countdown of delayed tasks as waiting
+    eta = task.request.eta
+    if eta:
+        eta = datetime.fromisoformat(eta).timestamp()
+        enqueued_at = max(enqueued_at, eta)
+    TASK_WAIT_SECONDS.labels(task.name).observe(
+        max(0, time.time() - enqueued_at)
+    )
+
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_SECONDS.labels(task.name, state or 'UNKNOWN').observe(
+            time.perf_counter() - started
+        )
+
+
+@task_retry.connect
+def count_retry(sender=None, **kwargs):
+    TASK_RETRIES.labels(sender.name).inc()
+
+
+@task_failure.connect
+def count_failure(sender=None, **kwargs):
+    TASK_FAILURES.labels(sender.name).inc()
+
+
+@worker_init.connect
+def serve_worker_metrics(**kwargs):
+    port = settings.WORKER_METRICS_PORT
+    if port:
+        start_http_server(port, registry=get_registry())
@@ -0,0 +1,99 @@
+"""
+Session engine reading through the cache and writing behind to the
+database.
+
+Saving a session only updates the cache and schedules a Celery task to
+write it to the database SESSION_WRITE_BEHIND_SECONDS later. Saves made
+meanwhile (OAuth state, login, ...) end up in that same single write.
+The cache has to be a shared one and should not evict sessions before
+they get written. Use it with:
+
+    SESSION_ENGINE=config.sessions
+"""
+
+import logging
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.cached_db import (
+    SessionStore as CachedDBStore,
+)
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+
+from kombu.exceptions import OperationalError
+
+from .db.utils import delete_in_batches
+
+logger = logging.getLogger(__name__)
+
+# Expired sessions are deleted this many at a time
+EXPIRED_BATCH_SIZE = 1000
+
+
+def delete_expired_sessions(batch_size=EXPIRED_BATCH_SIZE, pause=0):
+    """
+    Delete expired sessions in short statements that don't hold locks
+    on the whole table, sleeping `pause` seconds between them. Returns
+    the number of deleted sessions.
+    """
+    return delete_in_batches(
+        Session.objects.filter(expire_date__lt=timezone.now()),
+        batch_size,
+        pause,
+    )
+
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = 'config.sessions'
+
+    @property
+    def flush_key(self):
+        return self.cache_key + ':flush'
+
+    def save(self, must_create=False):
+        delay = settings.SESSION_WRITE_BEHIND_SECONDS
+        if not delay:
+            return super().save(must_create)
+        if self.session_key is None:
+            return self.create()
+
+        data = self._get_session(no_load=must_create)
+        age = self.get_expiry_age()
+        if must_create:
+            if not self._cache.add(self.cache_key, data, age):
+                raise CreateError
+        else:
+            self._cache.set(self.cache_key, data, age)
+
+        # Only schedule one write at a time, it picks up the latest data
+        if self._cache.add(self.flush_key, True, delay * 2):
+            from .tasks import flush_session
+
+            try:
+                flush_session.apply_async(
+                    (self.session_key, ), countdown=delay
+                )
+            except OperationalError:
+                logger.warning('Unable to schedule a session write')
+                self.write()
+
+    def write(self):
+        """Write the cached session to the database"""
+        # Saves from now on schedule a new write
+        self._cache.delete(self.flush_key)
+        data = self._cache.get(self.cache_key)
+        if data is None:
+            return  # Deleted or expired meanwhile
+        self._session_cache = data
+        self.model.objects.update_or_create(
+            session_key=self.session_key,
+            defaults={
+                'session_data': self.encode(data),
+                'expire_date': self.get_expiry_date(),
+            },
+        )
+
+    @classmethod
+    def clear_expired(cls):
+        delete_expired_sessions()
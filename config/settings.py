@@ -177,7 +177,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'config.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'config.db.routers.PinPrimaryMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -187,8 +189,11 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-if env('USE_CACHE_MIDDLEWARE', True, must_be_explicitly_false):
-    MIDDLEWARE.insert(1, 'django.middleware.cache.UpdateCacheMiddleware')
+# Site-wide caching only serves anonymous users, prefer per-view caching
+# with config.cache.cache_response. Off by default, so views that relied
+# on it need the decorator or USE_CACHE_MIDDLEWARE=True
+if env('USE_CACHE_MIDDLEWARE', False, must_be_explicitly_true):
+    MIDDLEWARE.insert(2, 'django.middleware.cache.UpdateCacheMiddleware')
     MIDDLEWARE.append('django.middleware.cache.FetchFromCacheMiddleware')
 
 if DEBUG:
@@ -203,6 +208,10 @@ if DEBUG:
 
 ROOT_URLCONF = 'config.urls'
 
+# Import the urls modules of project apps on first use instead of at
+# startup, see config.urls.AppURLResolver
+env('LAZY_APP_URLS', False, must_be_explicitly_true)
+
 APPEND_SLASH = False
 
 TEMPLATES = [
@@ -237,9 +246,37 @@ DATABASES = {
         'PORT': env('DB_PORT', None),
         'CONN_MAX_AGE': env('DB_CONN_MAX_AGE', 0, int),
         'AUTO_CREATE': env('DB_AUTO_CREATE', False, must_be_explicitly_true),
+        # Used by the config.db.backends.postgresql engine, which keeps
+        # connections open in a per-process pool; keep CONN_MAX_AGE at 0
+        'POOL': {
+            'MIN_SIZE': env('DB_POOL_MIN_SIZE', 0, int),
+            'MAX_SIZE': env('DB_POOL_MAX_SIZE', 10, int),
+            'TIMEOUT': env('DB_POOL_TIMEOUT', 10, float),
+            'MAX_IDLE': env('DB_POOL_MAX_IDLE', 300, float),
+            'PRE_PING': env(
+                'DB_POOL_PRE_PING', True, must_be_explicitly_false
+            ),
+        },
     }
 }
 
+# Read replicas by alias, with the settings that differ from the primary.
+# Example: DB_REPLICAS='{"replica1": {"HOST": "replica1.example.com"}}'
+DATABASES.update({
+    alias: {
+        **DATABASES['default'],
+        'AUTO_CREATE': False,
+        'TEST': {'MIRROR': 'default'},
+        **overrides,
+    }
+    for alias, overrides in env('DB_REPLICAS', {}, literal_eval).items()
+})
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['config.db.routers.ReplicaRouter']
+
+# Seconds clients read from the primary after a write, to see their writes
+env('DB_REPLICA_PIN_SECONDS', 10, int)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/dev/ref/settings/#default-auto-field
 
@@ -263,6 +300,31 @@ CACHES = {
 
 env('CACHE_MIDDLEWARE_SECONDS', 600, int)
 
+# Defaults for config.cache.cache_response: how long responses are fresh,
+# how long they can be served stale while being rebuilt and how long to
+# wait for another request building the same response
+env('CACHE_RESPONSE_SECONDS', 600, int)
+env('CACHE_RESPONSE_STALE_SECONDS', 60, int)
+env('CACHE_RESPONSE_WAIT', 5, int)
+
+
+# Sessions
+# https://docs.djangoproject.com/en/dev/topics/http/sessions/
+
+# Example: SESSION_ENGINE=config.sessions
+env('SESSION_ENGINE', 'django.contrib.sessions.backends.db')
+
+# How long config.sessions collects changes to a session before writing
+# them to the database, 0 writes right away
+env('SESSION_WRITE_BEHIND_SECONDS', 5, int)
+
+# Expired sessions are deleted every SESSION_CLEANUP_INTERVAL seconds,
+# SESSION_CLEANUP_BATCH_SIZE at a time with SESSION_CLEANUP_PAUSE seconds
+# in between, see config.tasks.clear_expired_sessions
+SESSION_CLEANUP_INTERVAL = env('SESSION_CLEANUP_INTERVAL', 3600, int)
+env('SESSION_CLEANUP_BATCH_SIZE', 1000, int)
+env('SESSION_CLEANUP_PAUSE', 0.1, float)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/dev/ref/settings/#auth-password-validators
@@ -320,6 +382,14 @@ env('EMAIL_USE_TLS', True, must_be_explicitly_false)
 DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL', 'no-reply@localhost')
 env('SERVER_EMAIL', 'root@localhost')
 
+# With EMAIL_BACKEND=config.mail.CeleryEmailBackend, Celery workers send
+# the messages using this backend, limiting the rate of send_emails tasks
+# per worker and retrying failed deliveries after a growing delay
+env('EMAIL_DELIVERY_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+env('EMAIL_RATE_LIMIT', '10/s')
+env('EMAIL_MAX_RETRIES', 5, int)
+env('EMAIL_RETRY_DELAY', 30, int)
+
 
 # Logging settings
 # https://docs.djangoproject.com/en/dev/topics/logging/
@@ -363,6 +433,66 @@ LOGIN_REDIRECT_URL = '/admin/'
 env('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 env('CELERY_RESULT_BACKEND', 'django-db')
 
+# Only tasks and calls with ignore_result=False store their results, e.g.
+# task.apply_async(ignore_result=False), which expire
+# after CELERY_RESULT_EXPIRES seconds. The django-db backend deletes them
+# every TASK_RESULTS_PRUNE_INTERVAL seconds, TASK_RESULTS_BATCH_SIZE rows
+# at a time, see config.tasks.prune_task_results
+env('CELERY_TASK_IGNORE_RESULT', True, must_be_explicitly_false)
+env('CELERY_RESULT_EXPIRES', 24 * 3600, int)
+env('TASK_RESULTS_BATCH_SIZE', 1000, int)
+
+CELERY_BEAT_SCHEDULE = {
+    # Takes the place of Celery's own daily task
+    'celery.backend_cleanup': {
+        'task': 'config.tasks.prune_task_results',
+        'schedule': env('TASK_RESULTS_PRUNE_INTERVAL', 3600, int),
+    },
+    'clear-expired-sessions': {
+        'task': 'config.tasks.clear_expired_sessions',
+        'schedule': SESSION_CLEANUP_INTERVAL,
+    },
+    'refresh-oauth-tokens': {
+        'task': 'users.tasks.refresh_oauth_tokens',
+        'schedule': env('OAUTH_REFRESH_INTERVAL', 300, int),
+    },
+}
+
+# Seconds a task based on config.celery.DedupTask drops duplicate calls for
+# at most, in case the running one never finishes. Needs a cache shared
+# with the workers, see CACHE_BACKEND
+env('TASK_DEDUP_TTL', 600, int)
+
+# Tasks go to the "default" queue unless routed elsewhere. I/O-bound ones
+# wait on the network most of the time and get a queue of their own
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+env('CELERY_TASK_ROUTES', {
+    'config.tasks.flush_session': {'queue': 'io'},
+    'config.tasks.send_emails': {'queue': 'io'},
+    'users.tasks.refresh_oauth_tokens': {'queue': 'io'},
+}, literal_eval)
+
+# Worker settings by profile, one per kind of queue, for
+# "python manage.py runcelery --profile <name>". The concurrency of
+# prefork workers defaults to the number of CPUs
+WORKER_PROFILES = {
+    'default': {
+        'queues': env('WORKER_DEFAULT_QUEUES', ['default'], str.split),
+        'pool': env('WORKER_DEFAULT_POOL', 'prefork'),
+        'concurrency': env('WORKER_DEFAULT_CONCURRENCY', None, int),
+        'prefetch_multiplier': env('WORKER_DEFAULT_PREFETCH', 4, int),
+    },
+    'io': {
+        'queues': env('WORKER_IO_QUEUES', ['io'], str.split),
+        'pool': env('WORKER_IO_POOL', 'threads'),
+        'concurrency': env('WORKER_IO_CONCURRENCY', 50, int),
+        'prefetch_multiplier': env('WORKER_IO_PREFETCH', 1, int),
+    },
+}
+
+# Port the workers serve their metrics on, see config.metrics
+env('WORKER_METRICS_PORT', None, int)
+
 
 # Django REST framework
 # https://www.django-rest-framework.org/
@@ -390,6 +520,8 @@ REST_REGISTRATION = {
     'REGISTER_EMAIL_VERIFICATION_URL': FRONT_END_ROOT + '/verify-email/',
     'REGISTER_VERIFICATION_AUTO_LOGIN': True,
     'REGISTER_VERIFICATION_ONE_TIME_USE': True,
+    'REGISTER_SERIALIZER_CLASS': 'users.serializers.RegisterUserSerializer',
+    'PROFILE_SERIALIZER_CLASS': 'users.serializers.UserProfileSerializer',
     'USER_PUBLIC_FIELDS': ('username', 'first_name', 'last_name', 'email'),
     'USER_VERIFICATION_FLAG_FIELD': 'is_verified',
     'VERIFICATION_FROM_EMAIL': DEFAULT_FROM_EMAIL,
@@ -415,6 +547,16 @@ META = {
 }
 
 # OAuth 2.0 config
+# The HTTP settings are the defaults for the matching per-provider options
+OAUTH_HTTP_CONNECT_TIMEOUT = env('OAUTH_HTTP_CONNECT_TIMEOUT', 3.05, float)
+OAUTH_HTTP_READ_TIMEOUT = env('OAUTH_HTTP_READ_TIMEOUT', 10, float)
+OAUTH_HTTP_RETRIES = env('OAUTH_HTTP_RETRIES', 2, int)
+OAUTH_HTTP_BREAKER_THRESHOLD = env('OAUTH_HTTP_BREAKER_THRESHOLD', 5, int)
+OAUTH_HTTP_BREAKER_RESET_TIMEOUT = env(
+    'OAUTH_HTTP_BREAKER_RESET_TIMEOUT', 30, float
+)
+OAUTH_HTTP_MAX_CONNECTIONS = env('OAUTH_HTTP_MAX_CONNECTIONS', 100, int)
+
 OAUTH_PROVIDERS = env('OAUTH_PROVIDERS', '')
 OAUTH = {
     provider.lower(): {
@@ -423,7 +565,40 @@ OAUTH = {
         'client_secret': env(provider + '_CLIENT_SECRET'),
         'scope': env(provider + '_SCOPE', ''),
         'token_uri': env(provider + '_TOKEN_URI'),
+        'jwks_uri': env(provider + '_JWKS_URI', None),
+        'userinfo_uri': env(provider + '_USERINFO_URI', None),
+        'connect_timeout': env(
+            provider + '_CONNECT_TIMEOUT', OAUTH_HTTP_CONNECT_TIMEOUT, float
+        ),
+        'read_timeout': env(
+            provider + '_READ_TIMEOUT', OAUTH_HTTP_READ_TIMEOUT, float
+        ),
+        'retries': env(provider + '_RETRIES', OAUTH_HTTP_RETRIES, int),
+        'breaker_threshold': env(
+            provider + '_BREAKER_THRESHOLD', OAUTH_HTTP_BREAKER_THRESHOLD, int
+        ),
+        'breaker_reset_timeout': env(
+            provider + '_BREAKER_RESET_TIMEOUT',
+            OAUTH_HTTP_BREAKER_RESET_TIMEOUT,
+            float,
+        ),
     }
     for provider in OAUTH_PROVIDERS.upper().split()
 }
 env('OAUTH_STATE_MAX_AGE', 3600, int)
+
+# Keep the OAuth state in the signed state parameter itself, rather than
+# in the session, so starting a login doesn't create a session row. Used
+# states are remembered in the cache, which needs to be a shared one
+env('OAUTH_STATE_STATELESS', False, must_be_explicitly_true)
+
+# Background refresh of access tokens expiring within the margin, see
+# users.tasks.refresh_oauth_tokens
+env('OAUTH_REFRESH_MARGIN', 600, int)
+env('OAUTH_REFRESH_BATCH_SIZE', 100, int)
+env('OAUTH_REFRESH_CONCURRENCY', 8, int)
+# Upper bound for a single run, after which another one can start
+env('OAUTH_REFRESH_LOCK', 3600, int)
+
+# Serve the OAuth views with async versions, for ASGI deployments only
+env('OAUTH_ASYNC', False, must_be_explicitly_true)
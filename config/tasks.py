@@ -0,0 +1,96 @@
+"""Celery tasks for the project-wide modules"""
+
+import logging
+import time
+from datetime import timedelta
+from smtplib import SMTPRecipientsRefused
+
+from django.conf import settings
+from django.utils import timezone
+
+from django_celery_results.models import TaskResult
+
+from .cache import acquire_lock, release_lock
+from .celery import DedupTask, app
+from .db.utils import delete_in_batches
+from .mail import close_delivery_connection, deliver_message
+from .sessions import SessionStore, delete_expired_sessions
+
+logger = logging.getLogger(__name__)
+
+
+@app.task(ignore_result=True)
+def flush_session(session_key):
+    """Write a session saved by `config.sessions` to the database"""
+    SessionStore(session_key).write()
+
+
+@app.task(
+    base=DedupTask,
+    bind=True,
+    ignore_result=True,
+    rate_limit=settings.EMAIL_RATE_LIMIT,
+    max_retries=settings.EMAIL_MAX_RETRIES,
+)
+def send_emails(self, messages):
+    """
+    Send a batch of messages queued by `config.mail.CeleryEmailBackend`
+    over the worker thread's open connection, retrying the unsent ones
+    with a growing delay if reconnecting fails. A batch that is queued again
+    while the same one is pending, like a double-clicked verification
+    email, is dropped.
+    """
+    for sent, fields in enumerate(messages):
+        try:
+            deliver_message(fields)
+        except SMTPRecipientsRefused as exception:
+            logger.exception('Recipients refused: %s', exception.recipients)
+        except Exception as exception:
+            # Failed after reconnecting too, try again later
+            close_delivery_connection()
+            delay = settings.EMAIL_RETRY_DELAY * 2 ** self.request.retries
+            raise self.retry(
+                args=(messages[sent:], ), exc=exception, countdown=delay,
+            )
+
+
+@app.task
+def prune_task_results():
+    """
+    Delete task results stored over CELERY_RESULT_EXPIRES seconds ago by
+    the django-db result backend, in batches. Replaces Celery's
+    `celery.backend_cleanup`, which deletes them in one statement.
+    Returns the number of deleted results.
+    """
+    expired = TaskResult.objects.filter(date_done__lt=(
+        timezone.now() - timedelta(seconds=settings.CELERY_RESULT_EXPIRES)
+    ))
+    return delete_in_batches(expired, settings.TASK_RESULTS_BATCH_SIZE)
+
+
+@app.task
+def clear_expired_sessions():
+    """
+    Delete expired sessions in batches, in place of the single statement
+    of "manage.py clearsessions". Returns the number of deleted sessions,
+    or None if another run is still in progress.
+    """
+    token = acquire_lock(
+        'clear-expired-sessions', settings.SESSION_CLEANUP_INTERVAL
+    )
+    if token is None:
+        return None
+    try:
+        started = time.monotonic()
+        deleted = delete_expired_sessions(
+            settings.SESSION_CLEANUP_BATCH_SIZE,
+            settings.SESSION_CLEANUP_PAUSE,
+        )
+        logger.info(
+            'Deleted %d expired sessions in %.1f seconds',
+            deleted,
+            time.monotonic() - started,
+        )
+        return deleted
+    finally:
+        release_lock('clear-expired-sessions', token)
@@ -1,15 +1,600 @@
+import asyncio
+import json
+import threading
+from datetime import timedelta
 from http import HTTPStatus
+from smtplib import SMTPServerDisconnected
+from types import SimpleNamespace
 
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.db import connections
+from django.db.backends.postgresql import base as postgresql
+from django.http import HttpResponse
 from django.template import Context, Template
+from django.test import RequestFactory
+from django.urls import URLPattern, get_resolver
+from django.utils import timezone
 
+import psycopg2.extensions
+import pytest
+from asgiref.sync import async_to_sync, sync_to_async
+from celery import Task
+from django_celery_results.models import TaskResult
+from prometheus_client import REGISTRY
 from rest_framework.reverse import reverse
 
-from .celery import debug_task
+from users.models import User
+
+from .cache import (
+    TieredCache,
+    acquire_lock,
+    cache_response,
+    release_lock,
+    response_key,
+    role_key,
+    user_key,
+)
+from .celery import DedupTask, debug_task
+from .db.backends.postgresql import base as pooled
+from .db.pool import ConnectionPool, PoolTimeout
+from .db.routers import (
+    PIN_COOKIE,
+    PinPrimaryMiddleware,
+    ReplicaRouter,
+    unpin_task,
+)
+from .mail import (
+    close_delivery_connection,
+    close_delivery_connections,
+    get_delivery_connection,
+)
+from .metrics import QUEUE_DEPTH, MetricsMiddleware, stamp_task, task_started
+from .sessions import SessionStore, delete_expired_sessions
+from .tasks import (
+    clear_expired_sessions,
+    flush_session,
+    prune_task_results,
+    send_emails,
+)
+from .urls import AppURLResolver
 
 
 def test_celery_task(celery_worker):
-    assert debug_task.delay().get(timeout=5) is None
+    result = debug_task.apply_async(ignore_result=False)
+    assert result.get(timeout=5) is None
+
+
+def test_app_url_resolver():
+    resolver = AppURLResolver('users.urls')
+    assert 'urlconf_module' not in resolver.__dict__  # Not imported yet
+    assert resolver.resolve('api/auth/').url_name == 'auth-root'
+    assert resolver.app_name is None
+
+    assert AppURLResolver('config.missing').url_patterns == []
+    with pytest.raises(ModuleNotFoundError):
+        AppURLResolver('missing.urls').url_patterns
+
+
+def test_cache_response(db):
+    calls = []
+
+    def view(request):
+        calls.append(request)
+        return HttpResponse(f'response {len(calls)}')
+
+    def get(user=None, view=cache_response(timeout=60)(view), **headers):
+        request = RequestFactory().get('/cached/', **headers)
+        request.user = user or AnonymousUser()
+        return view(request).content.decode()
+
+    cache.clear()
+    alice = User.objects.create(username='alice')
+    bob = User.objects.create(username='bob')
+
+    def lookups(result):
+        return REGISTRY.get_sample_value(
+            'cache_lookups_total', {'cache': 'response', 'result': result},
+        ) or 0
+
+    hits = lookups('hit')
+    assert get() == get() == 'response 1'
+    assert lookups('hit') == hits + 1
+    assert get(alice) == get(alice) == 'response 2'
+    assert get(bob) == 'response 3'
+
+    by_role = cache_response(timeout=60, per=role_key)(view)
+    assert get(alice, by_role) == get(bob, by_role) == 'response 4'
+
+    by_header = cache_response(timeout=60, headers=['Accept'])(view)
+    assert get(view=by_header, HTTP_ACCEPT='text/html') == 'response 5'
+    assert get(view=by_header, HTTP_ACCEPT='*/*') == 'response 6'
+
+    # Expired responses are served stale while the lock is taken
+    stale = cache_response(timeout=0, key_prefix='stale')(view)
+    assert get(view=stale) == 'response 7'
+    request = RequestFactory().get('/cached/')
+    request.user = AnonymousUser()
+    lock_key = response_key(request, 'stale', user_key, []) + ':lock'
+    cache.add(lock_key, True)
+    assert get(view=stale) == 'response 7'
+    cache.delete(lock_key)
+    assert get(view=stale) == 'response 8'
+
+    # Locks are only released by their holder
+    token = acquire_lock('lock', 60)
+    assert acquire_lock('lock', 60) is None
+    release_lock('lock', 'somebody else')
+    assert acquire_lock('lock', 60) is None
+    release_lock('lock', token)
+    assert acquire_lock('lock', 60) is not None
+
+
+def test_tiered_cache():
+    def node():
+        return TieredCache('tiered-test', {
+            'OPTIONS': {
+                'MAX_ENTRIES': 2,
+                'L2_BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'PUBSUB': 'config.cache.LocalPubSub',
+            },
+        })
+
+    a, b = node(), node()
+    a.clear()
+
+    a.set('spam', 1)
+    assert b.get('spam') == 1
+
+    # Served from process memory from now on
+    b.l2.set('spam', 2)
+    assert b.get('spam') == 1
+
+    # Writes elsewhere invalidate it
+    a.set('spam', 3)
+    assert b.get('spam') == 3
+    a.delete('spam')
+    assert b.get('spam') is None
+
+    a.set_many({'eggs': 1, 'ham': 2, 'bacon': 3})
+    assert b.get_many(['eggs', 'ham', 'bacon']) == {
+        'eggs': 1, 'ham': 2, 'bacon': 3,
+    }
+    assert len(b._local) == 2
+
+    assert not b.add('eggs', 4)
+    assert a.incr('eggs') == 2
+    assert b.get('eggs') == 2
+    a.clear()
+    assert b.get('ham') is None
+
+
+@pytest.mark.django_db
+def test_write_behind_sessions(settings, monkeypatch):
+    settings.SESSION_WRITE_BEHIND_SECONDS = 5
+    scheduled = []
+    monkeypatch.setattr(
+        flush_session,
+        'apply_async',
+        lambda args, countdown: scheduled.append(args[0]),
+    )
+
+    session = SessionStore()
+    session['state'] = 'abc'
+    session.save()
+    session['user'] = 1
+    session.save()
+    session.cycle_key()
+    session['last'] = True
+    session.save()
+
+    # Only the cache is written to until the scheduled writes run
+    assert not Session.objects.exists()
+    assert SessionStore(session.session_key).load()['last']
+    assert len(scheduled) == 2
+
+    for session_key in scheduled:
+        flush_session(session_key)
+    assert Session.objects.get().session_key == session.session_key
+    assert Session.objects.get().get_decoded() == {
+        'state': 'abc', 'user': 1, 'last': True,
+    }
+
+    session['last'] = False
+    session.save()
+    assert scheduled[-1] == session.session_key
+    session.delete()
+    flush_session(session.session_key)
+    assert not Session.objects.exists()
+
+
+@pytest.mark.django_db
+def test_delete_expired_sessions(settings):
+    expire_date = timezone.now()
+    Session.objects.bulk_create([
+        Session(session_key=f'{i:032}', session_data='', expire_date=(
+            expire_date + timedelta(days=1 if i % 2 else -1)
+        ))
+        for i in range(10)
+    ])
+    assert delete_expired_sessions(batch_size=2) == 5
+    assert Session.objects.count() == 5
+
+    Session.objects.update(expire_date=expire_date - timedelta(days=1))
+    settings.SESSION_CLEANUP_BATCH_SIZE = 2
+    settings.SESSION_CLEANUP_PAUSE = 0
+    assert clear_expired_sessions() == 5
+    assert not Session.objects.exists()
+
+
+@pytest.mark.django_db
+def test_delete_expired_sessions_replica_lag(settings):
+    # A lagging replica where a session the primary extended has expired.
+    # It's a separate in-memory database whatever the primary runs on
+    connections.settings['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:',
+    }
+    settings.DATABASE_REPLICAS = ['replica']
+    try:
+        with connections['replica'].schema_editor() as editor:
+            editor.create_model(Session)
+        expire_date = timezone.now()
+        for alias, days in [('default', 1), ('replica', -1)]:
+            Session.objects.using(alias).create(
+                session_key='active', session_data='',
+                expire_date=expire_date + timedelta(days=days),
+            )
+        unpin_task()  # As at the start of the cleanup task
+        assert delete_expired_sessions() == 0
+        assert Session.objects.using('default').filter(
+            session_key='active',
+        ).exists()
+    finally:
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+
+
+def test_connection_pool():
+    class Connection:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    def ping(connection):
+        if connection.closed:
+            raise ConnectionError
+
+    pool = ConnectionPool(Connection, max_size=2, timeout=0.01, ping=ping)
+    first, second = pool.checkout(), pool.checkout()
+    with pytest.raises(PoolTimeout):
+        pool.checkout()
+    assert pool.status()['checkout_timeouts'] == 1
+
+    # Most recently used first
+    pool.checkin(first)
+    pool.checkin(second)
+    assert pool.checkout() is second
+
+    # Broken connections are replaced
+    first.closed = True
+    third = pool.checkout()
+    assert third is not first
+    assert pool.status()['failed_pings'] == 1
+
+    pool.discard(third)
+    assert pool.status()['size'] == 1
+
+    # Idle connections above the minimum expire, checked on checkout too
+    pool.checkin(second)
+    pool.max_idle = 0
+    fourth = pool.checkout()
+    assert second.closed
+    assert fourth is not second
+    pool.checkin(fourth)
+    assert fourth.closed
+    assert pool.status()['size'] == 0
+
+
+def test_pooled_postgresql_backend(monkeypatch):
+    idle = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    class Connection:
+        closed = 0
+        isolation_level = None
+
+        def __init__(self):
+            self.info = SimpleNamespace(transaction_status=idle)
+            self.rolled_back = False
+
+        def rollback(self):
+            self.rolled_back = True
+            self.info.transaction_status = idle
+
+        def close(self):
+            self.closed = 1
+
+    monkeypatch.setattr(pooled, '_pools', {})
+    monkeypatch.setattr(
+        postgresql.DatabaseWrapper, 'get_new_connection',
+        lambda self, params: Connection(),
+    )
+    wrapper = pooled.DatabaseWrapper({
+        'NAME': 'app', 'USER': '', 'PASSWORD': '', 'HOST': '', 'PORT': '',
+        'OPTIONS': {}, 'POOL': {'MAX_SIZE': 1, 'PRE_PING': False},
+    }, 'pooled')
+
+    # Closing returns the connection to the pool
+    wrapper.connection = first = wrapper.get_new_connection({})
+    wrapper._close()
+    assert not first.closed
+    wrapper.connection = wrapper.get_new_connection({})
+    assert wrapper.connection is first
+
+    # Rolled back if left in a transaction, dropped if broken
+    first.info.transaction_status = (
+        psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    )
+    wrapper._close()
+    assert first.rolled_back
+    wrapper.connection = wrapper.get_new_connection({})
+    first.closed = 1
+    wrapper._close()
+    wrapper.connection = second = wrapper.get_new_connection({})
+    assert second is not first
+
+    assert REGISTRY.get_sample_value(
+        'db_pool_checkouts_total', {'database': 'pooled'},
+    ) == 4
+    assert REGISTRY.get_sample_value(
+        'db_pool_in_use', {'database': 'pooled'},
+    ) == 1
+    assert pooled.pool_status()['pooled']['connections_created'] == 2
+
+    # Closed inside an atomic block, it stays with the wrapper only
+    wrapper.in_atomic_block = True
+    wrapper._close()
+    assert second.closed
+    assert wrapper.get_new_connection({}) is not second
+
+
+def test_replica_router(settings):
+    settings.DATABASE_REPLICAS = ['replica']
+    router = ReplicaRouter()
+
+    def view(request):
+        response = HttpResponse()
+        response.read_from = router.db_for_read(User)
+        if request.method == 'POST':
+            router.db_for_write(User)
+            response.read_after_write = router.db_for_read(User)
+        return response
+
+    middleware = PinPrimaryMiddleware(view)
+    response = middleware(RequestFactory().get('/'))
+    assert response.read_from == 'replica'
+    assert PIN_COOKIE not in response.cookies
+
+    response = middleware(RequestFactory().post('/'))
+    assert response.read_after_write == 'default'
+    assert response.cookies[PIN_COOKIE]['max-age'] == (
+        settings.DB_REPLICA_PIN_SECONDS
+    )
+
+    # Pinned by the cookie, but not other clients, and not pinned again
+    request = RequestFactory().get('/')
+    request.COOKIES[PIN_COOKIE] = '1'
+    response = middleware(request)
+    assert response.read_from == 'default'
+    assert PIN_COOKIE not in response.cookies
+    assert middleware(RequestFactory().get('/')).read_from == 'replica'
+
+    async def async_view(request):
+        return await sync_to_async(view)(request)
+
+    middleware = PinPrimaryMiddleware(async_view)
+    assert asyncio.iscoroutinefunction(middleware)
+    response = async_to_sync(middleware)(RequestFactory().post('/'))
+    assert response.read_after_write == 'default'
+    assert PIN_COOKIE in response.cookies
+
+    assert not router.allow_migrate('replica', 'users')
+
+
+@pytest.mark.django_db
+def test_metrics(client, admin_client):
+    assert client.get(reverse('metrics')).status_code == HTTPStatus.FORBIDDEN
+
+    def lookups(result):
+        return REGISTRY.get_sample_value(
+            'django_request_cache_lookups_total',
+            {'view': 'api-root', 'result': result},
+        ) or 0
+
+    cache.clear()
+    hits, misses = lookups('hit'), lookups('miss')
+    admin_client.get(reverse('api-root'), HTTP_ACCEPT='text/html')
+    admin_client.get(reverse('api-root'))
+    admin_client.get(reverse('api-root'))
+    response = admin_client.get(reverse('metrics'))
+    assert response.status_code == HTTPStatus.OK
+    metrics = response.content.decode()
+    assert 'django_request_seconds_count{view="api-root"}' in metrics
+    assert 'django_request_db_queries_bucket{le="1.0",view="api-root"}' in (
+        metrics
+    )
+    assert 'django_request_cache_calls_bucket{le="5.0",view="api-root"}' in (
+        metrics
+    )
+    # The cached map is missed by the first request and hit by the second
+    assert lookups('miss') > misses
+    assert lookups('hit') > hits
+
+
+@pytest.mark.django_db(transaction=True)
+def test_metrics_middleware_async():
+    def queries():
+        return REGISTRY.get_sample_value(
+            'django_request_db_queries_sum', {'view': 'unresolved'},
+        ) or 0
+
+    async def view(request):
+        await sync_to_async(User.objects.count)()
+        return HttpResponse()
+
+    middleware = MetricsMiddleware(view)
+    assert asyncio.iscoroutinefunction(middleware)
+    before = queries()
+    async_to_sync(middleware)(RequestFactory().get('/'))
+    assert queries() == before + 1
+
+
+def test_celery_email_backend(settings, monkeypatch):
+    settings.EMAIL_BACKEND = 'config.mail.CeleryEmailBackend'
+    settings.EMAIL_DELIVERY_BACKEND = (
+        'django.core.mail.backends.locmem.EmailBackend'
+    )
+    queued = []
+    monkeypatch.setattr(send_emails, 'delay', queued.append)
+
+    message = mail.EmailMultiAlternatives(
+        'Welcome', 'Hello', 'from@example.com', ['to@example.com'],
+    )
+    message.attach_alternative('<p>Hello</p>', 'text/html')
+    assert mail.get_connection().send_messages([message, message]) == 2
+    assert not mail.outbox
+
+    # Sent by the worker over a single connection
+    close_delivery_connection()
+    send_emails(json.loads(json.dumps(queued[0])))
+    send_emails(queued[0])
+    assert len(mail.outbox) == 4
+    assert mail.outbox[0].subject == 'Welcome'
+    assert mail.outbox[0].alternatives == [('<p>Hello</p>', 'text/html')]
+
+    # Threads don't share connections
+    connection = get_delivery_connection()
+    connections = []
+    thread = threading.Thread(
+        target=lambda: connections.append(get_delivery_connection()),
+    )
+    thread.start()
+    thread.join()
+    assert connections[0] is not connection
+
+    # A connection closed while idle is reopened without retrying the task
+    send = locmem.EmailBackend.send_messages
+
+    def send_on_new_connection(backend, messages):
+        if backend is connection:
+            raise SMTPServerDisconnected()
+        return send(backend, messages)
+
+    monkeypatch.setattr(
+        locmem.EmailBackend, 'send_messages', send_on_new_connection,
+    )
+    send_emails(queued[0])
+    assert len(mail.outbox) == 6
+    assert get_delivery_connection() is not connection
+    close_delivery_connections()
+
+
+def test_dedup_task(monkeypatch):
+    cache.clear()
+    sent = []
+    monkeypatch.setattr(
+        Task, 'apply_async',
+        lambda self, args, kwargs, task_id, **options: sent.append(task_id),
+    )
+    retried = []
+    monkeypatch.setattr(
+        Task, 'retry', lambda self, args, kwargs, **options: retried.append(
+            self.apply_async(args, kwargs, task_id=self.request.id)
+        ),
+    )
+    task = DedupTask()
+    task.name = 'config.tests.dedup'
+
+    # Workers can't release calls in caches only this process sees
+    task.apply_async((1, ))
+    task.apply_async((1, ))
+    assert len(sent) == 2
+    sent.clear()
+    monkeypatch.setattr('config.celery.PROCESS_LOCAL_CACHES', ())
+
+    task.apply_async((1, ))
+    # Duplicates get the pending task, other arguments run
+    assert task.apply_async([1]).id == sent[0]
+    task.apply_async((2, ))
+    assert len(sent) == 2
+    # Retries are sent with the same id
+    task.apply_async((1, ), task_id=sent[0])
+    assert sent[2] == sent[0]
+
+    task.after_return('RETRY', None, sent[0], (1, ), {}, None)
+    assert task.apply_async((1, )).id == sent[0]
+    task.after_return('SUCCESS', None, sent[0], (1, ), {}, None)
+    task.apply_async((1, ))
+    assert len(sent) == 4
+    assert sent[3] != sent[0]
+
+    # Retried with other arguments, both calls are released when it's done
+    task.push_request(id=sent[3], args=[1], kwargs={})
+    task.retry(args=(2, 3), kwargs={})
+    task.pop_request()
+    assert sent[4] == sent[3]
+    task.after_return('RETRY', None, sent[3], (1, ), {}, None)
+    task.after_return('SUCCESS', None, sent[3], (2, 3), {}, None)
+    task.apply_async((1, ))
+    task.apply_async((2, 3))
+    assert len(sent) == 7
+    cache.clear()
+
+
+@pytest.mark.django_db
+def test_prune_task_results(settings):
+    settings.TASK_RESULTS_BATCH_SIZE = 2
+    TaskResult.objects.bulk_create([
+        TaskResult(task_id=f'task{i}') for i in range(10)
+    ])
+    TaskResult.objects.filter(task_id__in=['task1', 'task2', 'task3']).update(
+        date_done=timezone.now() - timedelta(
+            seconds=settings.CELERY_RESULT_EXPIRES + 1
+        ),
+    )
+    assert prune_task_results() == 3
+    assert TaskResult.objects.count() == 7
+
+
+def test_task_metrics():
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    runs = sample(
+        'celery_task_seconds_count', task=debug_task.name, state='SUCCESS',
+    )
+    debug_task.apply()
+    assert sample(
+        'celery_task_seconds_count', task=debug_task.name, state='SUCCESS',
+    ) == runs + 1
+
+    # Waiting starts when the task is sent, or when it's due if delayed
+    headers = {}
+    stamp_task(headers=headers)
+    for eta in (None, timezone.now().isoformat()):
+        task_started('id', SimpleNamespace(name='waiting', request=(
+            SimpleNamespace(enqueued_at=headers['enqueued_at'] - 60, eta=eta)
+        )))
+    assert 60 <= sample('celery_task_wait_seconds_sum', task='waiting') < 61
+
+    # No broker to ask
+    depth, = QUEUE_DEPTH.collect()
+    assert depth.samples == []
 
 
 def test_meta_template_tag(client):
@@ -22,3 +607,69 @@ def test_api_root(client):
     res = client.get(reverse('api-root'))
     assert res.status_code == HTTPStatus.OK
     assert 'auth' in res.json()
+
+
+def test_api_root_etag(client, budget):
+    cache.clear()
+    res = client.get(reverse('api-root'))
+    assert res.status_code == HTTPStatus.OK
+    etag = res['ETag']
+
+    # The rendered map comes from the cache after that
+    with budget(cache=1):
+        res = client.get(reverse('api-root'))
+    assert res['ETag'] == etag
+
+    res = client.get(reverse('api-root'), HTTP_IF_NONE_MATCH=etag)
+    assert res.status_code == HTTPStatus.NOT_MODIFIED
+
+    res = client.get(reverse('api-root'), HTTP_IF_NONE_MATCH='"surprise"')
+    assert res.status_code == HTTPStatus.OK
+
+    res = client.get(reverse('api-root'), HTTP_HOST='testserver:8000')
+    assert res['ETag'] != etag
+    assert 'testserver:8000' in res.json()['auth']
+
+    # The browsable API page has a CSRF token, it's hashed but not cached
+    with budget(cache=0):
+        res = client.get(reverse('api-root'), HTTP_ACCEPT='text/html')
+    assert res.status_code == HTTPStatus.OK
+    assert res['ETag'] != etag
+
+
+# Every endpoint of config.urls with its performance budget per request,
+# as (URL name, logged in as staff, budget)
+ENDPOINT_BUDGETS = [
+    ('index', False, {'queries': 0, 'cache': 0}),
+    ('admin:index', True, {'queries': 3, 'cache': 0}),
+    ('api-root', False, {'queries': 0, 'cache': 5, 'seconds': 1}),
+    ('metrics', True, {'queries': 2, 'cache': 0}),
+]
+
+
+def test_endpoint_budgets_cover_urls():
+    names = {
+        pattern.name for pattern in get_resolver('config.urls').url_patterns
+        if isinstance(pattern, URLPattern)
+    }
+    # Included URLconfs are budgeted by their apps
+    assert names | {'admin:index'} == {
+        name for name, *rest in ENDPOINT_BUDGETS
+    }
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    'name,staff,limits', ENDPOINT_BUDGETS,
+    ids=[name for name, *rest in ENDPOINT_BUDGETS],
+)
+def test_endpoint_budgets(
+    request, client, admin_client, budget, name, staff, limits
+):
+    # Measure cold caches, and don't leave cached responses behind
+    cache.clear()
+    request.addfinalizer(cache.clear)
+
+    with budget(**limits):
+        response = (admin_client if staff else client).get(reverse(name))
+    assert response.status_code < HTTPStatus.BAD_REQUEST
@@ -13,29 +13,68 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from importlib import import_module
 from importlib.util import find_spec
 
 from django.apps import apps
 from django.conf import settings
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import URLResolver, include, path
+from django.urls.resolvers import RoutePattern
+from django.utils.functional import cached_property
 from django.views.generic.base import RedirectView
 
-from .views import home
+from .views import home, metrics
 
 urlpatterns = [
     path('', RedirectView.as_view(url='api/'), name='index'),
     path('admin/', admin.site.urls),
     path('api/', home, name='api-root'),
+    path('api/metrics', metrics, name='metrics'),
 ]
 
+
+class AppURLResolver(URLResolver):
+    """
+    Resolver for an app's optional urls module that is imported on first
+    use rather than at startup. A missing module resolves to no patterns,
+    so apps don't have to be probed with `find_spec` up front either.
+    """
+
+    def __init__(self, urlconf_name):
+        super().__init__(RoutePattern(''), urlconf_name)
+
+    # Set by URLResolver.__init__, taken from the module like include() does
+    app_name = namespace = property(
+        lambda self: getattr(self.urlconf_module, 'app_name', None),
+        lambda self, value: None,
+    )
+
+    @cached_property
+    def urlconf_module(self):
+        try:
+            return import_module(self.urlconf_name)
+        except ModuleNotFoundError as e:
+            if e.name != self.urlconf_name:
+                raise
+            return None
+
+    @cached_property
+    def url_patterns(self):
+        return getattr(self.urlconf_module, 'urlpatterns', [])
+
+
 # Automatically add urls form urls.py for installed project apps
 for app in apps.get_app_configs():
     if not app.path.startswith(str(settings.BASE_DIR)):
         continue
 
     module = app.name + '.urls'
-    if find_spec(module) is not None and module != __name__:
+    if module == __name__:
+        continue
+    if settings.LAZY_APP_URLS:
+        urlpatterns += [AppURLResolver(module)]
+    elif find_spec(module) is not None:
         urlpatterns += [path('', include(module))]
 
 if settings.DEBUG:
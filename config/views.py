@@ -1,10 +1,28 @@
+import hashlib
+import json
+from functools import wraps
+
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.views.decorators.http import condition, conditional_page
+from django.views.decorators.vary import vary_on_headers
 
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
+from .cache import cache_response
+from .metrics import get_registry
+
+# Upper bound for the number of cached URL maps, which are kept per host
+URL_MAPS_MAX_SIZE = 256
+
+_url_maps = {}
+
 
 def format_doc(*args, **kwargs):
     def wrap(func):
@@ -13,10 +31,80 @@ def format_doc(*args, **kwargs):
     return wrap
 
 
-@api_view(['GET'])
-@permission_classes([AllowAny])
+def get_url_map(request, build):
+    """
+    Get the URL map built by `build(request)` and its ETag. URLs only
+    depend on the scheme and host, so the map is built once per those.
+    """
+    key = (
+        build,
+        request.scheme,
+        request.get_host(),
+        request.META.get('SCRIPT_NAME', ''),
+    )
+    # Another thread can clear the dict at any time, so read it only once
+    entry = _url_maps.get(key)
+    if entry is None:
+        url_map = build(request)
+        digest = hashlib.sha1(
+            json.dumps(url_map, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        if len(_url_maps) >= URL_MAPS_MAX_SIZE:
+            _url_maps.clear()
+        entry = _url_maps[key] = (url_map, f'"{digest}"')
+    return entry
+
+
+def is_browsable(request, format=None):
+    """Whether DRF is going to render the browsable API page"""
+    if 'api' in (format, request.GET.get('format')):
+        return True
+    return 'text/html' in request.META.get('HTTP_ACCEPT', '')
+
+
+def discovery_view(build):
+    """
+    Turn `build(request)`, returning a map of names to URLs, into an API
+    view serving the map with a strong ETag. Requests with a matching
+    If-None-Match get a 304 response before reaching DRF.
+
+    Other requests get the rendered map from the response cache, shared
+    between users. The browsable API page holds the user's CSRF token,
+    so it isn't cached but hashed once rendered, like
+    `ConditionalGetMiddleware` would.
+    """
+    def etag(request, format=None):
+        if is_browsable(request, format):
+            return None
+        return get_url_map(request, build)[1]
+
+    @api_view(['GET'])
+    @permission_classes([AllowAny])
+    @wraps(build)
+    def view(request, format=None):
+        return Response(get_url_map(request, build)[0])
+
+    cached_view = cache_response(per=None, headers=['Accept'])(view)
+
+    @wraps(view)
+    def map_cached_view(request, format=None):
+        if is_browsable(request, format):
+            return view(request, format=format)
+        return cached_view(request, format=format)
+
+    return conditional_page(vary_on_headers('Accept')(
+        condition(etag_func=etag)(map_cached_view)
+    ))
+
+
+@receiver(setting_changed)
+def clear_url_maps(**kwargs):
+    _url_maps.clear()
+
+
+@discovery_view
 @format_doc(**settings.META)
-def home(request, format=None):
+def home(request):
     """
     # Hello, World!
 
@@ -28,6 +116,14 @@ def home(request, format=None):
 
     Explore available endpoint using the links below:
     """
-    return Response({
+    return {
         'auth': reverse('auth-root', request=request),
-    })
+    }
+
+
+@api_view(['GET'])
+def metrics(request):
+    """Metrics in the Prometheus text format, for staff only"""
+    return HttpResponse(
+        generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST
+    )
@@ -0,0 +1,144 @@
+"""
+Performance budgets for requests made in tests:
+
+    @pytest.mark.budget(queries=2, cache=3, http=0, seconds=0.5)
+    def test_view(client):
+        client.get('/api/')
+
+fails the test if any request it makes runs more database queries,
+cache operations or outbound OAuth HTTP calls, or takes longer, than
+given. The `budget` fixture does the same for a block of code:
+
+    def test_view(client, budget):
+        with budget(queries=2):
+            client.get('/api/')
+"""
+
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import request_finished, request_started
+from django.db import connections
+
+import pytest
+
+CACHE_OPERATIONS = (
+    'add', 'get', 'set', 'touch', 'delete', 'get_many', 'has_key', 'incr',
+    'decr', 'set_many', 'delete_many', 'clear',
+)
+
+
+class Budget:
+    """Context manager checking each request made within it"""
+
+    def __init__(self, queries=None, cache=None, http=None, seconds=None):
+        self.limits = {
+            'queries': queries,
+            'cache': cache,
+            'http': http,
+            'seconds': seconds,
+        }
+        self.requests = []
+        self.current = None
+        self.depth = 0
+
+    def request_started(self, environ=None, scope=None, **kwargs):
+        self.current = {
+            'path': environ['PATH_INFO'] if environ else scope['path'],
+            'queries': 0,
+            'cache': 0,
+            'http': 0,
+            'seconds': time.perf_counter(),
+        }
+
+    def request_finished(self, **kwargs):
+        if self.current is not None:
+            self.current['seconds'] = (
+                time.perf_counter() - self.current['seconds']
+            )
+            self.requests.append(self.current)
+            self.current = None
+
+    def count(self, name):
+        if self.current is not None:
+            self.current[name] += 1
+
+    def count_query(self, execute, sql, params, many, context):
+        self.count('queries')
+        return execute(sql, params, many, context)
+
+    def count_cache(self, method):
+        def wrapper(cache, *args, **kwargs):
+            # Count get_many once, even if it's implemented with get
+            if self.depth == 0:
+                self.count('cache')
+            self.depth += 1
+            try:
+                return method(cache, *args, **kwargs)
+            finally:
+                self.depth -= 1
+        return wrapper
+
+    def count_http(self, record_http):
+        def wrapper(*args, **kwargs):
+            self.count('http')
+            return record_http(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        from users import clients
+
+        self.monkeypatch = pytest.MonkeyPatch()
+        for alias in settings.CACHES:
+            backend = type(caches[alias])
+            for name in CACHE_OPERATIONS:
+                self.monkeypatch.setattr(
+                    backend, name, self.count_cache(getattr(backend, name))
+                )
+        self.monkeypatch.setattr(
+            clients, 'record_http', self.count_http(clients.record_http)
+        )
+
+        request_started.connect(self.request_started)
+        request_finished.connect(self.request_finished)
+        self.stack = ExitStack()
+        for connection in connections.all():
+            self.stack.enter_context(
+                connection.execute_wrapper(self.count_query)
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stack.close()
+        request_started.disconnect(self.request_started)
+        request_finished.disconnect(self.request_finished)
+        self.monkeypatch.undo()
+
+        over_budget = [
+            f'{request["path"]}: {name} {request[name]:.3g} > {limit}'
+            for request in self.requests
+            for name, limit in self.limits.items()
+            if limit is not None and request[name] > limit
+        ]
+        if over_budget and exc_type is None:
+            pytest.fail('Over budget:\n' + '\n'.join(over_budget))
+
+
+@pytest.fixture
+def budget():
+    """Check the requests made in a `with budget(...):` block"""
+    return Budget
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    marker = item.get_closest_marker('budget')
+    if marker is None:
+        yield
+        return
+    budget = Budget(**marker.kwargs).__enter__()
+    outcome = yield
+    # Report the failure of the test rather than its budget, if it failed
+    budget.__exit__(*outcome.excinfo or (None, None, None))
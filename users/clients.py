@@ -0,0 +1,213 @@
+"""
+Outbound HTTP clients for talking to OAuth providers.
+
+Every provider gets its own pooled session (a keep-alive connection pool
+per event loop for the async client) with connect/read timeouts, a small
+retry budget and a circuit breaker, so a slow or failing provider can't
+tie up all the workers. Per-provider overrides are read from
+`settings.OAUTH`, see `option` for the available keys.
+"""
+
+import asyncio
+import threading
+import time
+from weakref import WeakKeyDictionary
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.translation import gettext as _
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from rest_framework.exceptions import AuthenticationFailed
+from urllib3.util.retry import Retry
+
+from config.metrics import record_http
+
+_lock = threading.Lock()
+_sessions = {}
+_breakers = {}
+_async_clients = WeakKeyDictionary()
+
+
+class CircuitBreaker:
+    """
+    Open the circuit after `threshold` consecutive failures and let a
+    single trial request through once `reset_timeout` seconds passed:
+
+    >>> breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    >>> breaker.failure(); breaker.allow()
+    True
+    >>> breaker.failure(); breaker.allow()
+    False
+    >>> breaker.opened_at -= 60; breaker.allow()
+    True
+    >>> breaker.allow()  # The trial request is still in progress
+    False
+    >>> breaker.success(); breaker.allow()
+    True
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: postpone the next trial until this one ends
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+def option(provider, name):
+    """
+    Get an HTTP client option for the provider. Available options and
+    the settings used as their defaults:
+
+        connect_timeout - OAUTH_HTTP_CONNECT_TIMEOUT
+        read_timeout - OAUTH_HTTP_READ_TIMEOUT
+        retries - OAUTH_HTTP_RETRIES
+        breaker_threshold - OAUTH_HTTP_BREAKER_THRESHOLD
+        breaker_reset_timeout - OAUTH_HTTP_BREAKER_RESET_TIMEOUT
+    """
+    default = getattr(settings, 'OAUTH_HTTP_' + name.upper())
+    return settings.OAUTH.get(provider, {}).get(name, default)
+
+
+def get_breaker(provider):
+    with _lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(
+                option(provider, 'breaker_threshold'),
+                option(provider, 'breaker_reset_timeout'),
+            )
+        return _breakers[provider]
+
+
+def get_session(provider):
+    """Long-lived pooled `requests` session for the provider"""
+    with _lock:
+        if provider not in _sessions:
+            # Only retry failed connection attempts: a request that
+            # reached the provider may have redeemed a single-use code
+            retry = Retry(
+                total=option(provider, 'retries'),
+                read=0,
+                status=0,
+                backoff_factor=0.1,
+            )
+            adapter = HTTPAdapter(
+                pool_maxsize=settings.OAUTH_HTTP_MAX_CONNECTIONS,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[provider] = session
+        return _sessions[provider]
+
+
+def get_async_client(provider):
+    """Long-lived async client for the provider and the running loop"""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(provider)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.OAUTH_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OAUTH_HTTP_MAX_CONNECTIONS,
+            ),
+            transport=httpx.AsyncHTTPTransport(
+                retries=option(provider, 'retries'),
+            ),
+        )
+        clients[provider] = client
+    return client
+
+
+def check_breaker(provider):
+    breaker = get_breaker(provider)
+    if not breaker.allow():
+        raise AuthenticationFailed(
+            _('OAuth provider %s is temporarily unavailable.') % provider
+        )
+    return breaker
+
+
+def record_response(breaker, status_code):
+    """Count server errors against the provider's circuit breaker"""
+    if status_code >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+
+
+def request(provider, method, url, **kwargs):
+    """Make a request to the provider using the shared session"""
+    breaker = check_breaker(provider)
+    started = time.monotonic()
+    try:
+        response = get_session(provider).request(method, url, timeout=(
+            option(provider, 'connect_timeout'),
+            option(provider, 'read_timeout'),
+        ), **kwargs)
+    except requests.RequestException:
+        record_http(provider, 'error', time.monotonic() - started)
+        breaker.failure()
+        raise AuthenticationFailed(
+            _('OAuth provider %s is unavailable.') % provider
+        )
+    record_http(provider, response.status_code, time.monotonic() - started)
+    record_response(breaker, response.status_code)
+    return response
+
+
+async def request_async(provider, method, url, **kwargs):
+    """Make a request to the provider using the shared async client"""
+    breaker = check_breaker(provider)
+    started = time.monotonic()
+    try:
+        response = await get_async_client(provider).request(
+            method, url, timeout=httpx.Timeout(
+                option(provider, 'read_timeout'),
+                connect=option(provider, 'connect_timeout'),
+            ), **kwargs
+        )
+    except httpx.HTTPError:
+        record_http(provider, 'error', time.monotonic() - started)
+        breaker.failure()
+        raise AuthenticationFailed(
+            _('OAuth provider %s is unavailable.') % provider
+        )
+    record_http(provider, response.status_code, time.monotonic() - started)
+    record_response(breaker, response.status_code)
+    return response
+
+
+@receiver(setting_changed)
+def reset_clients(setting, **kwargs):
+    if setting == 'OAUTH' or setting.startswith('OAUTH_HTTP_'):
+        with _lock:
+            _sessions.clear()
+            _breakers.clear()
+            _async_clients.clear()
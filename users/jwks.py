@@ -0,0 +1,143 @@
+"""
+Offline verification of OpenID Connect ID tokens.
+
+The provider's JSON Web Key Set is kept in process memory and in the
+Django cache, so verifying a token normally costs no network round
+trip. The key set is fetched again once its `Cache-Control` max-age
+runs out, or when a token is signed with a key we haven't seen yet
+(which is how providers rotate their keys).
+"""
+
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.translation import gettext as _
+
+import jwt
+from rest_framework.exceptions import AuthenticationFailed
+
+from config.metrics import record_cache
+
+from . import clients
+
+# Key sets without max-age are kept for this long, in seconds
+DEFAULT_MAX_AGE = 3600
+
+# Unknown key ids can't trigger fetching the key set more often than this
+MIN_REFRESH_INTERVAL = 60
+
+_locks = {}
+_key_sets = {}
+
+
+def max_age(cache_control):
+    """
+    Parse max-age out of a Cache-Control header value:
+
+    >>> max_age('public, max-age=19204, must-revalidate, no-transform')
+    19204
+    >>> max_age('no-cache') is None
+    True
+    """
+    match = re.search(r'max-age=(\d+)', cache_control or '')
+    return int(match.group(1)) if match else None
+
+
+def fetch_key_set(provider, uri):
+    """Download the key set and share it with other processes"""
+    response = clients.request(provider, 'GET', uri)
+    error = AuthenticationFailed(
+        _('Unable to get signing keys for OAuth provider %s.') % provider
+    )
+    if response.status_code != 200:
+        raise error
+    try:
+        keys = response.json()['keys']
+    except (KeyError, TypeError, ValueError):
+        raise error  # Not a key set, like an error page served with 200
+    key_set = {
+        'keys': keys,
+        'expires': time.time() + (
+            max_age(response.headers.get('Cache-Control')) or DEFAULT_MAX_AGE
+        ),
+        'fetched': time.time(),
+    }
+    cache.set(
+        f'jwks:{uri}', key_set, timeout=key_set['expires'] - time.time()
+    )
+    return key_set
+
+
+def find_key(key_set, kid):
+    """The key with the id if the key set is still fresh and has it"""
+    if key_set is None or key_set['expires'] <= time.time():
+        return None
+    for key in key_set['keys']:
+        if key.get('kid') == kid:
+            return key
+    return None
+
+
+def get_key(provider, uri, kid):
+    """Find the signing key by id, fetching the key set if needed"""
+    key = find_key(_key_sets.get(uri), kid)
+    if key is not None:
+        record_cache('jwks', 'local')
+        return key
+
+    # Fetch under the lock, so that only one thread ends up doing it.
+    # Verifications with known keys don't wait for it
+    with _locks.setdefault(uri, threading.Lock()):
+        key_set = _key_sets.get(uri)
+        if key_set is None or key_set['expires'] <= time.time():
+            key_set = cache.get(f'jwks:{uri}')
+        if key_set is None or key_set['expires'] <= time.time():
+            record_cache('jwks', 'miss')
+            key_set = fetch_key_set(provider, uri)
+        else:
+            record_cache('jwks', 'hit')
+
+        key = find_key(key_set, kid)
+        can_refresh = key_set['fetched'] + MIN_REFRESH_INTERVAL <= time.time()
+        if key is None and can_refresh:
+            key_set = fetch_key_set(provider, uri)
+            key = find_key(key_set, kid)
+
+        _key_sets[uri] = key_set
+
+    if key is None:
+        raise AuthenticationFailed(_('ID token signing key is unknown.'))
+    return key
+
+
+def verify_id_token(provider, token, jwks_uri, issuers):
+    """Verify the token signature, audience, issuer and expiry"""
+    try:
+        header = jwt.get_unverified_header(token)
+        key = get_key(provider, jwks_uri, header.get('kid'))
+        # OpenID Connect signs with RS256 unless the key says otherwise
+        algorithm = key.get('alg', 'RS256')
+        claims = jwt.decode(
+            token,
+            jwt.PyJWK(key, algorithm).key,
+            algorithms=[algorithm],
+            audience=settings.OAUTH[provider]['client_id'],
+            options={'require': ['exp', 'iss', 'sub']},
+        )
+    except jwt.PyJWTError:
+        raise AuthenticationFailed(_('ID token is invalid.'))
+
+    if claims['iss'] not in issuers:
+        raise AuthenticationFailed(_('ID token is invalid.'))
+    return claims
+
+
+@receiver(setting_changed)
+def reset_key_sets(setting, **kwargs):
+    if setting == 'OAUTH':
+        _key_sets.clear()
@@ -0,0 +1,237 @@
+"""Bulk import users from a CSV or JSON Lines file"""
+
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.apps import apps
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+
+from users.models import User
+from users.validators import validate_not_generated_username
+
+FIELDS = {
+    'username',
+    'email',
+    'first_name',
+    'last_name',
+    'is_active',
+    'is_staff',
+    'is_superuser',
+    'is_verified',
+}
+BOOLEAN_FIELDS = {'is_active', 'is_staff', 'is_superuser', 'is_verified'}
+
+
+def read_records(stream, format):
+    if format == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def hash_password(password):
+    # Empty passwords become unusable ones, which doesn't need hashing
+    return make_password(password or None)
+
+
+def setup_worker():
+    # Child processes that are spawned rather than forked start blank
+    if not apps.ready:
+        django.setup()
+
+
+class Command(BaseCommand):
+    help = (
+        'Import users from a CSV or JSON Lines file. Records can have a '
+        'raw "password" that gets hashed or an already hashed "password_'
+        'hash" in a format supported by PASSWORD_HASHERS.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Input file, "-" for stdin.')
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'],
+            help='Input format, guessed from the file extension by default.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of users inserted at a time.',
+        )
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count(),
+            help='Number of processes hashing passwords.',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='File to keep the progress in. Resumes from it if exists.',
+        )
+        parser.add_argument(
+            '--skip-existing', action='store_true',
+            help='Skip users with existing usernames instead of failing.',
+        )
+
+    def handle(self, *args, **options):
+        format = options['format'] or (
+            'jsonl' if options['path'].endswith(('.jsonl', '.json'))
+            else 'csv'
+        )
+        offset = self.load_checkpoint(options['checkpoint'])
+        if offset:
+            self.stdout.write(f'Resuming after {offset} records')
+
+        if options['path'] == '-':
+            stream = sys.stdin
+        else:
+            stream = open(options['path'], newline='', encoding='utf-8')
+
+        executor = None
+        if options['processes'] > 1:
+            executor = ProcessPoolExecutor(
+                options['processes'], initializer=setup_worker
+            )
+
+        imported = skipped = 0
+        started = time.monotonic()
+        try:
+            records = islice(read_records(stream, format), offset, None)
+            while True:
+                batch = list(islice(records, options['batch_size']))
+                if not batch:
+                    break
+
+                users = self.build_users(
+                    batch, executor, options['processes']
+                )
+                if options['skip_existing']:
+                    existing = set(User.objects.filter(
+                        username__in=[user.username for user in users]
+                    ).values_list('username', flat=True))
+                    users = [
+                        user for user in users
+                        if user.username not in existing
+                    ]
+                try:
+                    with transaction.atomic():
+                        # Still ignore conflicts with users created meanwhile
+                        User.objects.bulk_create(
+                            users, ignore_conflicts=options['skip_existing']
+                        )
+                except IntegrityError as exception:
+                    conflicts = ', '.join(self.find_conflicts(users))
+                    raise CommandError(
+                        f'Conflicting usernames after {offset} records: '
+                        f'{conflicts or exception}. Use --skip-existing to '
+                        f'skip existing users.'
+                    ) from exception
+                inserted = len(users)
+                if options['skip_existing']:
+                    inserted = self.count_inserted(users)
+
+                offset += len(batch)
+                imported += inserted
+                skipped += len(batch) - inserted
+                self.save_checkpoint(options['checkpoint'], offset)
+
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'Processed {offset} records, '
+                    f'{imported / elapsed:.0f} users/s'
+                )
+        except (KeyError, ValueError, ValidationError) as exception:
+            raise CommandError(
+                f'Invalid record after {offset} records: {exception!r}'
+            ) from exception
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} records, skipped {skipped} existing in '
+            f'{time.monotonic() - started:.1f}s'
+        ))
+
+    def build_users(self, batch, executor, processes):
+        raw_passwords = [
+            record.get('password') for record in batch
+            if not record.get('password_hash')
+        ]
+        if executor is not None:
+            chunksize = max(1, len(raw_passwords) // processes)
+            hashes = iter(executor.map(
+                hash_password, raw_passwords, chunksize=chunksize
+            ))
+        else:
+            hashes = map(hash_password, raw_passwords)
+
+        users = []
+        for record in batch:
+            fields = {
+                name: value for name, value in record.items()
+                if name in FIELDS
+            }
+            for name in BOOLEAN_FIELDS & fields.keys():
+                if isinstance(fields[name], str):
+                    fields[name] = fields[name].lower() in ['true', '1']
+
+            user = User(**fields)
+            if not user.username:
+                raise ValueError('Username is missing')
+            User.username_validator(user.username)
+            validate_not_generated_username(user.username)
+
+            if record.get('password_hash'):
+                # Raises ValueError for anything that isn't a known hash
+                identify_hasher(record['password_hash'])
+                user.password = record['password_hash']
+            else:
+                user.password = next(hashes)
+            users.append(user)
+        return users
+
+    def count_inserted(self, users):
+        """
+        How many of the users got inserted, rather than ignored because
+        of a conflict. Password hashes are salted, so a row with the
+        same username and hash is the one inserted.
+        """
+        passwords = {user.username: user.password for user in users}
+        rows = User.objects.filter(
+            username__in=list(passwords)
+        ).values_list('username', 'password')
+        return sum(passwords[name] == password for name, password in rows)
+
+    def find_conflicts(self, users):
+        """Usernames that exist already or repeat within the users"""
+        usernames = Counter(user.username for user in users)
+        existing = User.objects.filter(
+            username__in=list(usernames)
+        ).values_list('username', flat=True)
+        repeated = [name for name, count in usernames.items() if count > 1]
+        return sorted({*existing, *repeated})
+
+    def load_checkpoint(self, path):
+        if path is None or not os.path.exists(path):
+            return 0
+        with open(path) as file:
+            return json.load(file)['offset']
+
+    def save_checkpoint(self, path, offset):
+        if path is None:
+            return
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'offset': offset}, file)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.7 on 2021-09-20 14:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_user_oauth'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OAuthIdentity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=50, verbose_name='provider')),
+                ('subject', models.CharField(max_length=255, verbose_name='subject')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='oauth_identities', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'OAuth identity',
+                'verbose_name_plural': 'OAuth identities',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='oauthidentity',
+            constraint=models.UniqueConstraint(fields=('provider', 'subject'), name='users_oauthidentity_provider_subject'),
+        ),
+    ]
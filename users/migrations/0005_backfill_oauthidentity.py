@@ -0,0 +1,45 @@
+# Generated by Django 3.2.7 on 2021-09-20 14:12
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_oauth_identities(apps, schema_editor):
+    """Create an OAuthIdentity for every account found in User.oauth"""
+    User = apps.get_model('users', 'User')
+    OAuthIdentity = apps.get_model('users', 'OAuthIdentity')
+    db_alias = schema_editor.connection.alias
+
+    users = User.objects.using(db_alias).filter(oauth__isnull=False)
+    last_pk = 0
+    while True:
+        batch = list(
+            users.filter(pk__gt=last_pk)
+            .order_by('pk')
+            .values_list('pk', 'oauth')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+
+        OAuthIdentity.objects.using(db_alias).bulk_create([
+            OAuthIdentity(provider=provider, subject=subject, user_id=pk)
+            for pk, oauth in batch
+            for provider, accounts in (oauth or {}).items()
+            for subject in accounts
+        ], ignore_conflicts=True)
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_oauthidentity'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_oauth_identities,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2021-09-21 10:47
+
+from django.db import migrations, models
+
+
+def create_username_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE SEQUENCE IF NOT EXISTS users_username_seq START 10000000'
+        )
+
+
+def drop_username_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP SEQUENCE IF EXISTS users_username_seq')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_backfill_oauthidentity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsernameBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reserved_at', models.DateTimeField(auto_now_add=True, verbose_name='reserved at')),
+            ],
+        ),
+        migrations.RunPython(
+            create_username_sequence,
+            drop_username_sequence,
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 3.2.7 on 2021-09-23 16:20
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def copy_oauth_data(apps, schema_editor):
+    """Move the User.oauth responses over to the OAuthIdentity rows"""
+    User = apps.get_model('users', 'User')
+    OAuthIdentity = apps.get_model('users', 'OAuthIdentity')
+    db_alias = schema_editor.connection.alias
+
+    users = User.objects.using(db_alias).filter(oauth__isnull=False)
+    last_pk = 0
+    while True:
+        batch = dict(
+            users.filter(pk__gt=last_pk)
+            .order_by('pk')
+            .values_list('pk', 'oauth')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+
+        identities = list(
+            OAuthIdentity.objects.using(db_alias).filter(user__in=batch)
+        )
+        for identity in identities:
+            data = (
+                (batch[identity.user_id] or {})
+                .get(identity.provider, {})
+                .get(identity.subject, {})
+            )
+            identity.access_info = data.get('access_info')
+            identity.user_info = data.get('user_info')
+
+        OAuthIdentity.objects.using(db_alias).bulk_update(
+            identities, ['access_info', 'user_info'], batch_size=BATCH_SIZE
+        )
+        last_pk = max(batch)
+
+
+def restore_oauth_data(apps, schema_editor):
+    """Put the responses back into User.oauth"""
+    User = apps.get_model('users', 'User')
+    OAuthIdentity = apps.get_model('users', 'OAuthIdentity')
+    db_alias = schema_editor.connection.alias
+
+    user_ids = (
+        OAuthIdentity.objects.using(db_alias)
+        .values_list('user_id', flat=True)
+        .order_by('user_id')
+        .distinct()
+    )
+    last_pk = 0
+    while True:
+        batch = list(user_ids.filter(user_id__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+
+        users = {pk: User(pk=pk, oauth={}) for pk in batch}
+        identities = OAuthIdentity.objects.using(db_alias).filter(
+            user__in=batch
+        )
+        for identity in identities:
+            oauth = users[identity.user_id].oauth
+            oauth.setdefault(identity.provider, {})[identity.subject] = {
+                'access_info': identity.access_info,
+                'user_info': identity.user_info,
+            }
+
+        User.objects.using(db_alias).bulk_update(
+            users.values(), ['oauth'], batch_size=BATCH_SIZE
+        )
+        last_pk = batch[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_username_allocation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oauthidentity',
+            name='access_info',
+            field=models.JSONField(blank=True, null=True, verbose_name='access info'),
+        ),
+        migrations.AddField(
+            model_name='oauthidentity',
+            name='user_info',
+            field=models.JSONField(blank=True, null=True, verbose_name='user info'),
+        ),
+        migrations.RunPython(copy_oauth_data, restore_oauth_data),
+    ]
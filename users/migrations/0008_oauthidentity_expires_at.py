@@ -0,0 +1,18 @@
+# Generated by Django 3.2.7 on 2021-09-27 11:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_oauthidentity_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oauthidentity',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='access token expires at'),
+        ),
+    ]
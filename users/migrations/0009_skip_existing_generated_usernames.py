@@ -0,0 +1,48 @@
+# Generated by Django 3.2.7 on 2021-09-28 09:14
+
+from django.db import migrations
+
+FIRST_NUMBER = 10 ** 7
+BLOCK_SIZE = 100
+
+
+def skip_existing_usernames(apps, schema_editor):
+    """
+    Users created before the usernames got reserved could have picked a
+    generated-looking one, move the allocation past the highest of them
+    """
+    User = apps.get_model('users', 'User')
+    UsernameBlock = apps.get_model('users', 'UsernameBlock')
+    db_alias = schema_editor.connection.alias
+    # Numbers longer than 18 digits are out of reach of both allocators
+    usernames = User.objects.using(db_alias).filter(
+        username__regex=r'^user[0-9]{8,18}$'
+    ).values_list('username', flat=True)
+    highest = max((int(name[4:]) for name in usernames.iterator()), default=0)
+    if highest < FIRST_NUMBER:
+        return
+
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'SELECT setval(%s, GREATEST(%s, last_value)) '
+            'FROM users_username_seq',
+            ['users_username_seq', highest],
+        )
+        return
+
+    # Block ids map to number ranges, see users.usernames.next_number
+    block = (highest - FIRST_NUMBER) // BLOCK_SIZE + 1
+    blocks = UsernameBlock.objects.using(db_alias)
+    if not blocks.filter(pk__gte=block).exists():
+        blocks.create(pk=block)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_oauthidentity_expires_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(skip_existing_usernames, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.7 on 2021-09-28 10:02
+
+from django.db import migrations
+
+import users.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_skip_existing_generated_usernames'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', users.models.DeferredOAuthUserManager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.7 on 2021-09-28 11:12
+
+import django.contrib.auth.validators
+from django.db import migrations, models
+
+import users.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_user_manager'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='username',
+            field=models.CharField(error_messages={'unique': 'A user with that username already exists.'}, help_text='Required. 150 characters or fewer. Letters, digits and @/./+/-/_ only.', max_length=150, unique=True, validators=[django.contrib.auth.validators.UnicodeUsernameValidator(), users.validators.validate_not_generated_username], verbose_name='username'),
+        ),
+    ]
@@ -1,9 +1,96 @@
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
+from .validators import GENERATED_USERNAME, validate_not_generated_username
+
+
+class DeferredOAuthUserManager(UserManager):
+    """Leave the deprecated `User.oauth` data out of loaded users"""
+
+    def get_queryset(self):
+        return super().get_queryset().defer('oauth')
+
 
 class User(AbstractUser):
     """Custom User model"""
+    # Generated usernames are reserved, whichever way users get created
+    username = models.CharField(
+        _('username'),
+        max_length=150,
+        unique=True,
+        help_text=_(
+            'Required. 150 characters or fewer. Letters, digits and '
+            '@/./+/-/_ only.'
+        ),
+        validators=[
+            AbstractUser.username_validator,
+            validate_not_generated_username,
+        ],
+        error_messages={
+            'unique': _('A user with that username already exists.'),
+        },
+    )
     is_verified = models.BooleanField(_('email verified'), default=False)
+
+    # Deprecated, moved over to OAuthIdentity. Kept while code that reads
+    # it may still be running, to be dropped in the following release
     oauth = models.JSONField(_('OAuth 2.0 data'), blank=True, null=True)
+
+    objects = DeferredOAuthUserManager()
+
+    def clean_fields(self, exclude=None):
+        # Users signed up with OAuth keep the username generated for them
+        if self.pk is not None and GENERATED_USERNAME.fullmatch(
+            self.username or ''
+        ):
+            stored = User._base_manager.filter(pk=self.pk).values_list(
+                'username', flat=True
+            ).first()
+            if stored == self.username:
+                exclude = [*(exclude or []), 'username']
+        super().clean_fields(exclude)
+
+
+class OAuthIdentity(models.Model):
+    """
+    An account at an OAuth 2.0 provider linked to a user.
+
+    Lets the OAuth callback find the user with a single indexed lookup,
+    and keeps the provider's token and user info responses out of the
+    user row loaded on every authenticated request.
+    """
+    provider = models.CharField(_('provider'), max_length=50)
+    subject = models.CharField(_('subject'), max_length=255)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='oauth_identities',
+        verbose_name=_('user'),
+    )
+    access_info = models.JSONField(_('access info'), blank=True, null=True)
+    user_info = models.JSONField(_('user info'), blank=True, null=True)
+    expires_at = models.DateTimeField(
+        _('access token expires at'), blank=True, null=True, db_index=True,
+    )
+
+    class Meta:
+        verbose_name = _('OAuth identity')
+        verbose_name_plural = _('OAuth identities')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['provider', 'subject'],
+                name='users_oauthidentity_provider_subject',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.provider}:{self.subject}'
+
+
+class UsernameBlock(models.Model):
+    """
+    Reservation of a block of generated usernames, used instead of a
+    sequence on databases that don't have them. See `users.usernames`.
+    """
+    reserved_at = models.DateTimeField(_('reserved at'), auto_now_add=True)
@@ -0,0 +1,289 @@
+"""
+OAuth 2.0 flow helpers shared by the sync and async views.
+
+Apart from fetching ID token signing keys (which are cached, see
+`users.jwks`) everything here is free of network calls, so that each
+view can use the HTTP client that suits it.
+"""
+
+import json
+import random
+from base64 import b64decode, b64encode
+from datetime import timedelta
+from string import ascii_letters, digits
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth import login
+from django.core import signing
+from django.core.cache import cache
+from django.core.signing import BadSignature, SignatureExpired, TimestampSigner
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.reverse import reverse
+
+from .jwks import verify_id_token
+from .models import OAuthIdentity, User
+from .usernames import generate_username
+
+GOOGLE_JWKS_URI = 'https://www.googleapis.com/oauth2/v3/certs'
+GOOGLE_ISSUERS = ['https://accounts.google.com', 'accounts.google.com']
+FACEBOOK_USERINFO_URI = 'https://graph.facebook.com/me'
+
+STATE_SALT = 'users.providers.state'
+STATE_COOKIE = 'oauth_state'
+
+
+def random_token(length=15, alphabet=ascii_letters + digits):
+    """Generate a random string of a specific length"""
+    return ''.join(random.choice(alphabet) for i in range(length))
+
+
+def make_state(request, provider):
+    """Create the state parameter for the authorization request"""
+    if settings.OAUTH_STATE_STATELESS:
+        # The state carries everything the callback needs, signed and
+        # timestamped, so no session has to be written. Its nonce goes to
+        # a cookie too (see `bind_state`), so that a state can't be used
+        # from another browser. Replays are prevented by remembering used
+        # nonces in the cache
+        request.oauth_state_nonce = random_token()
+        return signing.dumps({
+            'nonce': request.oauth_state_nonce,
+            'provider': provider,
+            'next': request.GET.get('next', None),
+        }, salt=STATE_SALT)
+
+    # If state parameter gets sniffed, it is possible to forge a url
+    # that can log user to another OAuth account. We can use Django's
+    # TimestampSigner to hash the state value and prevent that
+    # Using the signer instead of a hasher to add timestamp
+    if 'state_validation' not in request.session:
+        request.session['state_validation'] = random_token()
+
+    signer = TimestampSigner()
+    signed_validation = signer.sign(request.session['state_validation'])
+    state = {
+        'signature': signed_validation.split(':', 1)[1],
+        'next': request.GET.get('next', None),
+    }
+    return b64encode(json.dumps(state).encode('utf-8'))
+
+
+def authorization_url(request, provider):
+    """Provider URL to redirect the user to for the authorization"""
+    return settings.OAUTH[provider]['auth_uri'] + '?' + urlencode({
+        'response_type': 'code',
+        'client_id': settings.OAUTH[provider]['client_id'],
+        'redirect_uri': reverse(
+            'oauth-callback', (provider, ), request=request
+        ),
+        'scope': settings.OAUTH[provider]['scope'],
+        'state': make_state(request, provider),
+    })
+
+
+def bind_state(request, response):
+    """Tie the stateless state to the browser starting the login"""
+    if settings.OAUTH_STATE_STATELESS:
+        response.set_signed_cookie(
+            STATE_COOKIE,
+            request.oauth_state_nonce,
+            salt=STATE_SALT,
+            max_age=settings.OAUTH_STATE_MAX_AGE,
+            secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True,
+            samesite='Lax',
+        )
+    return response
+
+
+def unbind_state(response):
+    """Remove the cookie set by `bind_state` once the login is done"""
+    if settings.OAUTH_STATE_STATELESS:
+        response.delete_cookie(STATE_COOKIE, samesite='Lax')
+    return response
+
+
+def check_state(request, provider):
+    """Validate the state parameter of the callback and return it"""
+    try:
+        if settings.OAUTH_STATE_STATELESS:
+            state = signing.loads(
+                request.GET['state'],
+                salt=STATE_SALT,
+                max_age=settings.OAUTH_STATE_MAX_AGE,
+            )
+            nonce = request.get_signed_cookie(
+                STATE_COOKIE,
+                None,
+                salt=STATE_SALT,
+                max_age=settings.OAUTH_STATE_MAX_AGE,
+            )
+            if state['provider'] != provider or state['nonce'] != nonce:
+                raise BadSignature()
+            if not cache.add(
+                f'oauth-state:{state["nonce"]}',
+                True,
+                timeout=settings.OAUTH_STATE_MAX_AGE,
+            ):
+                raise AuthenticationFailed(_('State has already been used.'))
+            return state
+
+        state = json.loads(b64decode(request.GET['state']))
+        signer = TimestampSigner()
+        signer.unsign(
+            f'{request.session["state_validation"]}:{state["signature"]}',
+            max_age=settings.OAUTH_STATE_MAX_AGE
+        )
+        del request.session['state_validation']
+    except SignatureExpired:
+        raise AuthenticationFailed(_('State expired.'))
+    except (KeyError, BadSignature):
+        raise AuthenticationFailed(_('State is missing or invalid.'))
+    return state
+
+
+def token_request(request, provider):
+    """Keyword arguments for the code - token exchange POST request"""
+    return {
+        'url': settings.OAUTH[provider]['token_uri'],
+        'data': {
+            'code': request.GET.get('code', ''),
+            'client_id': settings.OAUTH[provider]['client_id'],
+            'client_secret': settings.OAUTH[provider]['client_secret'],
+            'grant_type': 'authorization_code',
+            'redirect_uri': reverse(
+                'oauth-callback', (provider, ), request=request
+            ),
+        },
+        'headers': {
+            'Accept': 'application/json',
+            'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8',
+        },
+    }
+
+
+def refresh_request(provider, refresh_token):
+    """Keyword arguments for the access token refresh POST request"""
+    return {
+        'url': settings.OAUTH[provider]['token_uri'],
+        'data': {
+            'client_id': settings.OAUTH[provider]['client_id'],
+            'client_secret': settings.OAUTH[provider]['client_secret'],
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+        },
+        'headers': {
+            'Accept': 'application/json',
+            'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8',
+        },
+    }
+
+
+def token_expiry(access_info):
+    """
+    When the access token expires, if the provider told us and it can be
+    refreshed, for `users.tasks.refresh_oauth_tokens`. Tokens that can't
+    be refreshed stay out of its schedule:
+
+    >>> token_expiry({'access_token': 'abc', 'expires_in': 60}) is None
+    True
+    """
+    if 'expires_in' not in access_info or 'refresh_token' not in access_info:
+        return None
+    return timezone.now() + timedelta(seconds=int(access_info['expires_in']))
+
+
+def user_info_request(provider, access_info):
+    """
+    Keyword arguments for the user info POST request or None if the
+    provider doesn't need one.
+    """
+    if provider == 'facebook':
+        uri = settings.OAUTH[provider].get('userinfo_uri')
+        return {
+            'url': uri or FACEBOOK_USERINFO_URI,
+            'data': {'fields': 'first_name,last_name,email'},
+            'headers': {
+                'Authorization': f'Bearer {access_info["access_token"]}',
+            },
+        }
+    return None
+
+
+def parse_user_info(provider, access_info, user_info=None):
+    """
+    Extract the user profile from the provider's token or user info
+    response.
+    """
+    if provider == 'google':
+        user_info = verify_id_token(
+            provider,
+            access_info.get('id_token', ''),
+            settings.OAUTH[provider].get('jwks_uri') or GOOGLE_JWKS_URI,
+            GOOGLE_ISSUERS,
+        )
+        return {
+            'user_id': user_info['sub'],
+            'first_name': user_info.get('given_name', ''),
+            'last_name': user_info.get('family_name', ''),
+            'email': user_info.get('email', ''),
+            'email_verified': user_info.get('email_verified', False),
+            'user_info': user_info,
+        }
+
+    if provider == 'facebook' and user_info is not None:
+        return {
+            'user_id': user_info['id'],
+            'first_name': user_info.get('first_name', ''),
+            'last_name': user_info.get('last_name', ''),
+            'email': user_info.get('email', ''),
+            'email_verified': bool(user_info.get('email', '')),
+            'user_info': user_info,
+        }
+
+    raise AuthenticationFailed(
+        _('Unable to get user info for OAuth provider %s.') % provider
+    )
+
+
+def login_user(request, provider, access_info, profile):
+    """
+    If the user isn't logged in already, try to log him in based on the
+    OAuth user id, if it doesn't exist then a new user is created and
+    logged in.
+
+    If the user is logged in already, then the OAuth account gets linked
+    to the user.
+    """
+    try:
+        identity = OAuthIdentity.objects.select_related('user').get(
+            provider=provider, subject=profile['user_id'],
+        )
+    except OAuthIdentity.DoesNotExist:
+        identity = OAuthIdentity(provider=provider, subject=profile['user_id'])
+
+    if request.user.is_authenticated:
+        identity.user = request.user
+    elif identity.pk is None:
+        identity.user = User(
+            username=generate_username(),
+            first_name=profile['first_name'],
+            last_name=profile['last_name'],
+            email=profile['email'],
+            is_verified=profile['email_verified'],
+        )
+        identity.user.set_unusable_password()
+        identity.user.save()
+
+    # Providers may omit the refresh token on later authorizations
+    identity.access_info = {**(identity.access_info or {}), **access_info}
+    identity.user_info = profile['user_info']
+    identity.expires_at = token_expiry(identity.access_info)
+    identity.save()
+
+    login(request, identity.user)
+    return identity.user
@@ -0,0 +1,37 @@
+from rest_registration.api.serializers import (
+    DefaultRegisterUserSerializer,
+    DefaultUserProfileSerializer,
+)
+
+from .validators import validate_not_generated_username
+
+
+class RegisterUserSerializer(DefaultRegisterUserSerializer):
+    """Registration that doesn't let people pick generated usernames"""
+
+    def validate_username(self, value):
+        validate_not_generated_username(value)
+        return value
+
+
+class UserProfileSerializer(DefaultUserProfileSerializer):
+    """
+    Profile that doesn't let people switch to a generated username, but
+    lets users signed up with OAuth keep theirs
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        username = fields.get('username')
+        if username is not None:
+            # Checked against the current username in validate_username
+            username.validators = [
+                validator for validator in username.validators
+                if validator is not validate_not_generated_username
+            ]
+        return fields
+
+    def validate_username(self, value):
+        if self.instance is None or value != self.instance.username:
+            validate_not_generated_username(value)
+        return value
@@ -0,0 +1,113 @@
+"""Celery tasks for the users app"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http import HTTPStatus
+
+from django.conf import settings
+from django.utils import timezone
+
+from rest_framework.exceptions import APIException
+
+from config.cache import acquire_lock, release_lock
+from config.celery import app
+
+from . import clients
+from .models import OAuthIdentity
+from .providers import refresh_request, token_expiry
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_access_token(identity):
+    """
+    Refresh the identity's access token in place, returning whether it
+    changed. Identities whose refresh gets rejected drop out of the
+    schedule until the next login, those the provider fails to refresh
+    are retried on the next run.
+    """
+    try:
+        response = clients.request(
+            identity.provider,
+            'POST',
+            **refresh_request(
+                identity.provider, identity.access_info['refresh_token']
+            ),
+        )
+    except APIException:
+        return False  # Provider is unavailable, try again on the next run
+
+    status = response.status_code
+    if status == HTTPStatus.TOO_MANY_REQUESTS or status >= 500:
+        return False  # Provider is overloaded or failing, try again later
+    if status != HTTPStatus.OK:
+        identity.expires_at = None
+        return True
+
+    # Providers may omit the refresh token if it stays the same
+    identity.access_info = {**identity.access_info, **response.json()}
+    try:
+        identity.expires_at = token_expiry(identity.access_info)
+    except (TypeError, ValueError):
+        # Keep the new tokens, but stop refreshing them in the background
+        identity.expires_at = None
+    return True
+
+
+def refresh_or_log(identity):
+    """Make sure one failed identity doesn't lose the whole batch"""
+    try:
+        return refresh_access_token(identity)
+    except Exception:
+        logger.exception('Failed to refresh OAuth identity %s', identity.pk)
+        return False
+
+
+@app.task(ignore_result=True)
+def refresh_oauth_tokens():
+    """
+    Refresh provider access tokens that expire in the next
+    OAUTH_REFRESH_MARGIN seconds. Returns the number of identities
+    processed, or None if another run is still in progress.
+    """
+    # Overlapping runs would use up each other's rotating refresh tokens
+    token = acquire_lock('refresh-oauth-tokens', settings.OAUTH_REFRESH_LOCK)
+    if token is None:
+        return None
+    try:
+        return refresh_due_tokens()
+    finally:
+        release_lock('refresh-oauth-tokens', token)
+
+
+def refresh_due_tokens():
+    due = OAuthIdentity.objects.filter(
+        expires_at__lte=timezone.now() + timedelta(
+            seconds=settings.OAUTH_REFRESH_MARGIN
+        ),
+        provider__in=list(settings.OAUTH),
+        access_info__has_key='refresh_token',
+    ).order_by('pk')
+
+    processed = 0
+    last_pk = 0
+    with ThreadPoolExecutor(settings.OAUTH_REFRESH_CONCURRENCY) as executor:
+        while True:
+            batch = list(
+                due.filter(pk__gt=last_pk)[:settings.OAUTH_REFRESH_BATCH_SIZE]
+            )
+            if not batch:
+                return processed
+
+            # Rows left alone may have been updated by a login meanwhile
+            changed = [
+                identity for identity, refreshed
+                in zip(batch, executor.map(refresh_or_log, batch))
+                if refreshed
+            ]
+            OAuthIdentity.objects.bulk_update(
+                changed, ['access_info', 'expires_at']
+            )
+            processed += len(batch)
+            last_pk = batch[-1].pk
@@ -1,18 +1,49 @@
 import json
-import random
+import time
 from base64 import b64encode
+from datetime import timedelta
 from http import HTTPStatus
-
+from importlib import import_module
+from io import StringIO
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from django.apps import apps as django_apps
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
 from django.core.signing import TimestampSigner
+from django.db import connection
+from django.test import AsyncRequestFactory, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, get_resolver
+from django.utils import timezone
 
 import factory
+import httpx
+import jwt
 import pytest
 import requests
+from asgiref.sync import async_to_sync
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
 from pytest_factoryboy import register
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.reverse import reverse
 from rest_registration.signals import user_activated
+from rest_registration.signers.register import RegisterSigner
+from rest_registration.signers.register_email import RegisterEmailSigner
+from rest_registration.signers.reset_password import ResetPasswordSigner
 
-from .models import User
+from . import clients, jwks, usernames, views
+from .models import OAuthIdentity, User, UsernameBlock
+from .tasks import refresh_oauth_tokens
+from .usernames import generate_username
+from .validators import GENERATED_USERNAME
 
 
 @register
@@ -24,6 +55,14 @@ class UserFactory(factory.django.DjangoModelFactory):
         django_get_or_create = ('username', )
 
 
+def mock_provider_requests(monkeypatch, fake_post):
+    """Serve requests of the shared provider sessions using `fake_post`"""
+    def fake_request(session, method, url, data=None, headers=None, **kw):
+        return fake_post(url, data, headers)
+
+    monkeypatch.setattr(requests.Session, 'request', fake_request)
+
+
 @pytest.mark.django_db
 def test_user_create():
     user = User(username='foo')
@@ -117,6 +156,84 @@ def test_oauth_callback_state_validation(client, settings):
     assert res.json()['detail'] == 'State expired.'
 
 
+@pytest.mark.django_db
+def test_oauth_stateless_state(client, settings, monkeypatch):
+    settings.OAUTH_STATE_STATELESS = True
+    settings.OAUTH = {
+        'facebook': {
+            'auth_uri': 'https://facebook.com/oauth',
+            'client_id': 'myclientid',
+            'client_secret': 'mysecret',
+            'scope': 'myscope',
+            'token_uri': 'https://facebook.com/token',
+        }
+    }
+
+    def fake_facebook_success(url, data, headers):
+        res = lambda: None
+        res.status_code = HTTPStatus.OK
+        response_json = {
+            'expires_in': 42,
+            'token_type': 'bearer',
+            'access_token': 'abc',
+        }
+
+        if url == 'https://graph.facebook.com/me':
+            response_json = {
+                'id': '456',
+                'first_name': 'John',
+                'last_name': 'Doe',
+                'email': 'jd@example.com'
+            }
+
+        res.json = lambda: response_json
+        return res
+
+    mock_provider_requests(monkeypatch, fake_facebook_success)
+
+    res = client.get(
+        reverse('oauth-provider', ('facebook', )), {'next': '/welcome'}
+    )
+    assert res.status_code == HTTPStatus.FOUND
+    assert Session.objects.count() == 0
+    state = parse_qs(urlparse(res.url).query)['state'][0]
+    cookie = client.cookies['oauth_state'].value
+
+    # States are bound to the browser that started the login
+    res = Client().get(
+        reverse('oauth-callback', ('facebook', )), {'state': state}
+    )
+    assert res.status_code == HTTPStatus.FORBIDDEN
+    assert res.json()['detail'] == 'State is missing or invalid.'
+
+    # States are bound to the provider
+    settings.OAUTH['google'] = settings.OAUTH['facebook']
+    res = client.get(reverse('oauth-callback', ('google', )), {'state': state})
+    assert res.status_code == HTTPStatus.FORBIDDEN
+
+    res = client.get(
+        reverse('oauth-callback', ('facebook', )), {'state': state}
+    )
+    assert res.status_code == HTTPStatus.FOUND
+    assert res.url == '/welcome'
+    assert res.cookies['oauth_state'].value == ''
+
+    # States are single-use, even with the cookie put back
+    client.logout()
+    client.cookies['oauth_state'] = cookie
+    res = client.get(
+        reverse('oauth-callback', ('facebook', )), {'state': state}
+    )
+    assert res.status_code == HTTPStatus.FORBIDDEN
+    assert res.json()['detail'] == 'State has already been used.'
+
+    res = client.get(
+        reverse('oauth-callback', ('facebook', )), {'state': state + 'x'}
+    )
+    assert res.status_code == HTTPStatus.FORBIDDEN
+    assert res.json()['detail'] == 'State is missing or invalid.'
+
+
 @pytest.mark.django_db
 def test_oauth_bad_token_endpoint(client, settings, monkeypatch):
     settings.OAUTH = {
@@ -143,7 +260,7 @@ def test_oauth_bad_token_endpoint(client, settings, monkeypatch):
         res.status_code = HTTPStatus.BAD_REQUEST
         return res
 
-    monkeypatch.setattr(requests, 'post', fake_token_endpoint_error)
+    mock_provider_requests(monkeypatch, fake_token_endpoint_error)
     res = client.get(
         reverse('oauth-callback', ('myprovider', )),
         {'state': state},
@@ -152,7 +269,58 @@ def test_oauth_bad_token_endpoint(client, settings, monkeypatch):
 
 
 @pytest.mark.django_db
-def test_oauth_callback_google(client, settings, monkeypatch):
+def test_oauth_provider_circuit_breaker(client, settings, monkeypatch):
+    settings.OAUTH = {
+        'myprovider': {
+            'auth_uri': 'https://spam.eggs',
+            'client_id': 'myclientid',
+            'client_secret': 'mysecret',
+            'scope': 'myscope',
+            'token_uri': 'https://foo.bar',
+            'breaker_threshold': 2,
+        }
+    }
+
+    signer = TimestampSigner()
+    state = {b64encode(json.dumps({
+        'signature': signer.sign('abc').split(':', 1)[1],
+        'next': None,
+    }).encode('utf-8'))}
+
+    calls = []
+
+    def fake_token_endpoint_timeout(url, data, headers):
+        calls.append(url)
+        raise requests.Timeout()
+
+    def fake_token_endpoint_unavailable(url, data, headers):
+        calls.append(url)
+        res = lambda: None
+        res.status_code = HTTPStatus.SERVICE_UNAVAILABLE
+        return res
+
+    for fake_post, detail in [
+        (fake_token_endpoint_timeout, 'is unavailable'),
+        (fake_token_endpoint_unavailable, 'token exchange failed'),
+        (fake_token_endpoint_unavailable, 'temporarily unavailable'),
+    ]:
+        mock_provider_requests(monkeypatch, fake_post)
+        session = client.session
+        session['state_validation'] = 'abc'
+        session.save()
+
+        res = client.get(
+            reverse('oauth-callback', ('myprovider', )),
+            {'state': state},
+        )
+        assert res.status_code == HTTPStatus.FORBIDDEN
+        assert detail in res.json()['detail']
+
+    assert len(calls) == 2
+
+
+@pytest.mark.django_db
+def test_oauth_callback_google(client, settings, monkeypatch, budget):
     settings.OAUTH = {
         'google': {
             'auth_uri': 'https://google.com/oauth',
@@ -160,47 +328,151 @@ def test_oauth_callback_google(client, settings, monkeypatch):
             'client_secret': 'mysecret',
             'scope': 'myscope',
             'token_uri': 'https://google.com/token',
+            'jwks_uri': 'https://google.com/certs',
         }
     }
+    cache.delete('jwks:https://google.com/certs')
+
+    def make_key(kid):
+        private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048
+        )
+        public_jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+        public_jwk.update({'kid': kid, 'alg': 'RS256', 'use': 'sig'})
+        return private_key, public_jwk
+
+    private_key, public_jwk = make_key('first')
+    served_keys = [public_jwk]
+    id_token_claims = {
+        'iss': 'https://accounts.google.com',
+        'aud': 'myclientid',
+        'exp': int(time.time()) + 3600,
+        'sub': '123',
+        'given_name': 'John',
+        'family_name': 'Doe',
+        'email': 'jd@example.com',
+    }
+    id_token = jwt.encode(
+        id_token_claims, private_key, 'RS256', headers={'kid': 'first'}
+    )
+    jwks_requests = []
 
     def fake_google_success(url, data, headers):
         res = lambda: None
         res.status_code = HTTPStatus.OK
+        res.headers = {}
         response_json = {
             'expires_in': 42,
             'token_type': 'bearer',
             'access_token': 'abc',
-            'id_token': 'foo.%s.bar' % (b64encode(json.dumps({
-                'sub': '123',
-                'given_name': 'John',
-                'family_name': 'Doe',
-                'email': 'jd@example.com',
-            }).encode())).decode()
+            'id_token': id_token,
         }
+
+        if url == 'https://google.com/certs':
+            jwks_requests.append(url)
+            res.headers = {'Cache-Control': 'public, max-age=3600'}
+            response_json = {'keys': list(served_keys)}
+
         res.json = lambda: response_json
         return res
 
-    monkeypatch.setattr(requests, 'post', fake_google_success)
+    mock_provider_requests(monkeypatch, fake_google_success)
 
     signer = TimestampSigner()
     state = {b64encode(json.dumps({
         'signature': signer.sign('abc').split(':', 1)[1],
         'next': None,
     }).encode('utf-8'))}
-    session = client.session
-    session['state_validation'] = 'abc'
-    session.save()
 
-    res = client.get(
-        reverse('oauth-callback', ('google', )),
-        {'state': state},
-    )
+    def login_with_google():
+        client.logout()
+        session = client.session
+        session['state_validation'] = 'abc'
+        session.save()
+        return client.get(
+            reverse('oauth-callback', ('google', )),
+            {'state': state},
+        )
+
+    # Signing up fetches the key set
+    with budget(queries=16, cache=2, http=2):
+        res = login_with_google()
     assert res.status_code == HTTPStatus.OK
     assert res.json() == '123'
 
+    # The key set is cached, no more requests for it
+    with budget(queries=13, cache=0, http=1):
+        res = login_with_google()
+    assert res.status_code == HTTPStatus.OK
+    assert len(jwks_requests) == 1
+
+    # Forged signature
+    forged_key = make_key('first')[0]
+    id_token = jwt.encode(
+        id_token_claims, forged_key, 'RS256', headers={'kid': 'first'}
+    )
+    res = login_with_google()
+    assert res.status_code == HTTPStatus.FORBIDDEN
+    assert res.json()['detail'] == 'ID token is invalid.'
+
+    # Issued for another client
+    id_token = jwt.encode(
+        {**id_token_claims, 'aud': 'surprise'},
+        private_key,
+        'RS256',
+        headers={'kid': 'first'},
+    )
+    res = login_with_google()
+    assert res.status_code == HTTPStatus.FORBIDDEN
+
+    # Expired
+    id_token = jwt.encode(
+        {**id_token_claims, 'exp': int(time.time()) - 60},
+        private_key,
+        'RS256',
+        headers={'kid': 'first'},
+    )
+    res = login_with_google()
+    assert res.status_code == HTTPStatus.FORBIDDEN
+
+    # Rotated key, an unknown key id triggers fetching the key set
+    monkeypatch.setattr(jwks, 'MIN_REFRESH_INTERVAL', 0)
+    private_key, public_jwk = make_key('second')
+    served_keys.append(public_jwk)
+    id_token = jwt.encode(
+        id_token_claims, private_key, 'RS256', headers={'kid': 'second'}
+    )
+    with budget(queries=13, cache=1, http=2):
+        res = login_with_google()
+    assert res.status_code == HTTPStatus.OK
+    assert len(jwks_requests) == 2
+
+    # Known keys don't wait for another thread fetching the key set
+    with jwks._locks['https://google.com/certs']:
+        with budget(queries=13, cache=0, http=1):
+            res = login_with_google()
+    assert res.status_code == HTTPStatus.OK
+
+
+def test_jwks_invalid_key_set(settings, monkeypatch):
+    settings.OAUTH = {'google': {'client_id': 'myclientid'}}
+    bodies = [lambda: json.loads('<html>'), lambda: {'error': 'oops'}]
+
+    def fake_certs(url, data, headers):
+        res = lambda: None
+        res.status_code = HTTPStatus.OK
+        res.headers = {}
+        res.json = bodies.pop(0)
+        return res
+
+    mock_provider_requests(monkeypatch, fake_certs)
+    while bodies:
+        with pytest.raises(AuthenticationFailed):
+            jwks.fetch_key_set('google', 'https://google.com/certs')
+
 
 @pytest.mark.django_db
-def test_oauth_callback_facebook(client, settings, monkeypatch):
+def test_oauth_callback_facebook(client, settings, monkeypatch, budget):
     settings.OAUTH = {
         'facebook': {
             'auth_uri': 'https://facebook.com/oauth',
@@ -231,7 +503,7 @@ def test_oauth_callback_facebook(client, settings, monkeypatch):
         res.json = lambda: response_json
         return res
 
-    monkeypatch.setattr(requests, 'post', fake_facebook_success)
+    mock_provider_requests(monkeypatch, fake_facebook_success)
 
     signer = TimestampSigner()
     state = {b64encode(json.dumps({
@@ -242,10 +514,11 @@ def test_oauth_callback_facebook(client, settings, monkeypatch):
     session['state_validation'] = 'abc'
     session.save()
 
-    res = client.get(
-        reverse('oauth-callback', ('facebook', )),
-        {'state': state},
-    )
+    with budget(queries=16, cache=0, http=2):
+        res = client.get(
+            reverse('oauth-callback', ('facebook', )),
+            {'state': state},
+        )
     assert res.status_code == HTTPStatus.OK
     assert res.json() == '456'
 
@@ -264,7 +537,7 @@ def test_oauth_callback_facebook(client, settings, monkeypatch):
         res.json = lambda: response_json
         return res
 
-    monkeypatch.setattr(requests, 'post', fake_facebook_me_error)
+    mock_provider_requests(monkeypatch, fake_facebook_me_error)
 
     session = client.session
     session['state_validation'] = 'abc'
@@ -301,7 +574,7 @@ def test_oauth_callback_unsupported_provider(client, settings, monkeypatch):
         res.json = lambda: response_json
         return res
 
-    monkeypatch.setattr(requests, 'post', fake_token_success)
+    mock_provider_requests(monkeypatch, fake_token_success)
 
     signer = TimestampSigner()
     state = {b64encode(json.dumps({
@@ -321,7 +594,7 @@ def test_oauth_callback_unsupported_provider(client, settings, monkeypatch):
 
 
 @pytest.mark.django_db
-def test_oauth_username_collision(client, settings, monkeypatch):
+def test_oauth_generated_usernames(client, settings, monkeypatch):
     settings.OAUTH = {
         'facebook': {
             'auth_uri': 'https://facebook.com/oauth',
@@ -332,6 +605,8 @@ def test_oauth_username_collision(client, settings, monkeypatch):
         }
     }
 
+    facebook_ids = iter(['456', '789'])
+
     def fake_facebook_success(url, data, headers):
         res = lambda: None
         res.status_code = HTTPStatus.OK
@@ -343,7 +618,7 @@ def test_oauth_username_collision(client, settings, monkeypatch):
 
         if url == 'https://graph.facebook.com/me':
             response_json = {
-                'id': '456',
+                'id': next(facebook_ids),
                 'first_name': 'John',
                 'last_name': 'Doe',
                 'email': 'jd@example.com'
@@ -352,16 +627,132 @@ def test_oauth_username_collision(client, settings, monkeypatch):
         res.json = lambda: response_json
         return res
 
-    def fake_random_choice(alphabet, invoked=[0]):
-        invoked[0] += 1
-        if invoked[0] > 50:
-            return 'y'
-        return 'x'
+    mock_provider_requests(monkeypatch, fake_facebook_success)
 
-    monkeypatch.setattr(random, 'choice', fake_random_choice)
-    monkeypatch.setattr(requests, 'post', fake_facebook_success)
+    signer = TimestampSigner()
+    state = {b64encode(json.dumps({
+        'signature': signer.sign('abc').split(':', 1)[1],
+        'next': None,
+    }).encode('utf-8'))}
+
+    for _ in range(2):
+        client.logout()
+        session = client.session
+        session['state_validation'] = 'abc'
+        session.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            res = client.get(
+                reverse('oauth-callback', ('facebook', )),
+                {'state': state},
+            )
+        assert res.status_code == HTTPStatus.OK
+        insert = 'INSERT INTO ' + connection.ops.quote_name('users_user')
+        assert len([
+            query for query in queries if query['sql'].startswith(insert)
+        ]) == 1
+
+    usernames = User.objects.values_list('username', flat=True)
+    assert len(set(usernames)) == 2
+    # Without refresh tokens there is nothing to schedule refreshes for
+    assert not OAuthIdentity.objects.filter(expires_at__isnull=False)
+    assert all(GENERATED_USERNAME.fullmatch(name) for name in usernames)
+
+    # Users signed up with OAuth can keep their username, not take another
+    profile = client.get(reverse('rest_registration:profile')).json()
+    res = client.put(
+        reverse('rest_registration:profile'), profile,
+        content_type='application/json',
+    )
+    assert res.status_code == HTTPStatus.OK
+    res = client.patch(
+        reverse('rest_registration:profile'), {'username': 'user12345678'},
+        content_type='application/json',
+    )
+    assert res.status_code == HTTPStatus.BAD_REQUEST
+    assert 'username' in res.json()
 
-    User(username='userxxxxxxx', email='asdf@asdf').save()
+    res = client.post(
+        reverse('rest_registration:register'),
+        data={
+            'username': 'user12345678',
+            'email': 'bar@baz.spam',
+            'password': 'x@j(w2wxu^038614b',
+            'password_confirm': 'x@j(w2wxu^038614b',
+        }
+    )
+    assert res.status_code == HTTPStatus.BAD_REQUEST
+    assert 'username' in res.json()
+
+
+@pytest.mark.django_db
+def test_generated_usernames_reserved_on_model():
+    with pytest.raises(ValidationError):
+        User(username='user12345678', password='x').full_clean()
+    with pytest.raises(CommandError):
+        call_command(
+            'createsuperuser', '--noinput',
+            username='user12345678', email='foo@bar.baz', stdout=StringIO(),
+        )
+
+    # OAuth users can still be edited while keeping their username
+    oauth_user = User.objects.create(username=generate_username())
+    oauth_user.set_unusable_password()
+    oauth_user.first_name = 'Foo'
+    oauth_user.full_clean()
+
+    oauth_user.username = 'user12345678'
+    with pytest.raises(ValidationError):
+        oauth_user.full_clean()
+
+
+@pytest.mark.django_db
+def test_skip_existing_generated_usernames(monkeypatch):
+    migration = import_module(
+        'users.migrations.0009_skip_existing_generated_usernames'
+    )
+    highest = UsernameBlock.objects.count() * 100 + 10 ** 7 + 250
+    User.objects.create(username=f'user{highest}')
+    schema_editor = SimpleNamespace(connection=connection)
+    migration.skip_existing_usernames(django_apps, schema_editor)
+
+    monkeypatch.setattr(usernames, '_blocks', {})
+    assert int(generate_username()[4:]) > highest
+
+
+@pytest.mark.django_db
+def test_oauth_existing_user(client, settings, monkeypatch, user, budget):
+    settings.OAUTH = {
+        'facebook': {
+            'auth_uri': 'https://facebook.com/oauth',
+            'client_id': 'myclientid',
+            'client_secret': 'mysecret',
+            'scope': 'myscope',
+            'token_uri': 'https://facebook.com/token',
+        }
+    }
+
+    def fake_facebook_success(url, data, headers):
+        res = lambda: None
+        res.status_code = HTTPStatus.OK
+        response_json = {
+            'expires_in': 42,
+            'token_type': 'bearer',
+            'access_token': 'abc',
+        }
+
+        if url == 'https://graph.facebook.com/me':
+            response_json = {
+                'id': '456',
+                'first_name': 'John',
+                'last_name': 'Doe',
+                'email': 'jd@example.com'
+            }
+
+        res.json = lambda: response_json
+        return res
+
+    mock_provider_requests(monkeypatch, fake_facebook_success)
 
     signer = TimestampSigner()
     state = {b64encode(json.dumps({
@@ -372,26 +763,39 @@ def test_oauth_username_collision(client, settings, monkeypatch):
     session['state_validation'] = 'abc'
     session.save()
 
-    res = client.get(
-        reverse('oauth-callback', ('facebook', )),
-        {'state': state},
-    )
+    client.force_login(user)
+
+    with budget(queries=8, cache=0, http=2):
+        res = client.get(
+            reverse('oauth-callback', ('facebook', )),
+            {'state': state},
+        )
     assert res.status_code == HTTPStatus.OK
 
-    client.logout()
+    identity = user.oauth_identities.get(provider='facebook', subject='456')
+    assert identity.access_info['access_token'] == 'abc'
+    assert identity.user_info['first_name'] == 'John'
+
+    # Later logins without a refresh token keep the stored one
+    identity.access_info['refresh_token'] = 'xyz'
+    identity.save()
     session = client.session
     session['state_validation'] = 'abc'
     session.save()
-
-    res = client.get(
-        reverse('oauth-callback', ('facebook', )),
-        {'state': state},
-    )
+    with budget(queries=8, cache=0, http=2):
+        res = client.get(
+            reverse('oauth-callback', ('facebook', )),
+            {'state': state},
+        )
     assert res.status_code == HTTPStatus.OK
 
+    identity.refresh_from_db()
+    assert identity.access_info['refresh_token'] == 'xyz'
+    assert identity.expires_at is not None
+
 
 @pytest.mark.django_db
-def test_oauth_existing_user(client, settings, monkeypatch, user):
+def test_oauth_identity_lookup(client, settings, monkeypatch):
     settings.OAUTH = {
         'facebook': {
             'auth_uri': 'https://facebook.com/oauth',
@@ -422,27 +826,32 @@ def test_oauth_existing_user(client, settings, monkeypatch, user):
         res.json = lambda: response_json
         return res
 
-    monkeypatch.setattr(requests, 'post', fake_facebook_success)
+    mock_provider_requests(monkeypatch, fake_facebook_success)
 
     signer = TimestampSigner()
     state = {b64encode(json.dumps({
         'signature': signer.sign('abc').split(':', 1)[1],
         'next': None,
     }).encode('utf-8'))}
-    session = client.session
-    session['state_validation'] = 'abc'
-    session.save()
 
-    client.force_login(user)
+    for _ in range(2):
+        client.logout()
+        session = client.session
+        session['state_validation'] = 'abc'
+        session.save()
 
-    res = client.get(
-        reverse('oauth-callback', ('facebook', )),
-        {'state': state},
-    )
-    assert res.status_code == HTTPStatus.OK
+        res = client.get(
+            reverse('oauth-callback', ('facebook', )),
+            {'state': state},
+        )
+        assert res.status_code == HTTPStatus.OK
 
-    user.refresh_from_db()
-    assert user.oauth['facebook']['456']
+    identity = OAuthIdentity.objects.get(provider='facebook', subject='456')
+    assert User.objects.count() == 1
+    assert int(client.session['_auth_user_id']) == identity.user_id
+
+    # The deprecated blob column isn't loaded along with users
+    assert User.objects.get().get_deferred_fields() == {'oauth'}
 
 
 @pytest.mark.django_db
@@ -477,7 +886,7 @@ def test_oauth_next_redirect(client, settings, monkeypatch):
         res.json = lambda: response_json
         return res
 
-    monkeypatch.setattr(requests, 'post', fake_facebook_success)
+    mock_provider_requests(monkeypatch, fake_facebook_success)
 
     signer = TimestampSigner()
     state = {b64encode(json.dumps({
@@ -496,6 +905,182 @@ def test_oauth_next_redirect(client, settings, monkeypatch):
     assert 'welcome' in res.url
 
 
+@pytest.mark.django_db
+def test_oauth_async_views(settings, monkeypatch):
+    settings.OAUTH = {
+        'facebook': {
+            'auth_uri': 'https://facebook.com/oauth',
+            'client_id': 'myclientid',
+            'client_secret': 'mysecret',
+            'scope': 'myscope',
+            'token_uri': 'https://facebook.com/token',
+        }
+    }
+
+    def fake_facebook_success(request):
+        response_json = {
+            'expires_in': 42,
+            'token_type': 'bearer',
+            'access_token': 'abc',
+        }
+
+        if request.url == 'https://graph.facebook.com/me':
+            response_json = {
+                'id': '456',
+                'first_name': 'John',
+                'last_name': 'Doe',
+                'email': 'jd@example.com'
+            }
+
+        return httpx.Response(HTTPStatus.OK, json=response_json)
+
+    monkeypatch.setattr(
+        clients,
+        'get_async_client',
+        lambda provider: httpx.AsyncClient(
+            transport=httpx.MockTransport(fake_facebook_success),
+        ),
+    )
+
+    factory = AsyncRequestFactory()
+    session = SessionStore()
+
+    request = factory.get(reverse('oauth-provider', ('facebook', )))
+    request.session = session
+    res = async_to_sync(views.provider_async)(request, provider='facebook')
+    assert res.status_code == HTTPStatus.FOUND
+    assert res.url.startswith('https://facebook.com/oauth')
+
+    signer = TimestampSigner()
+    state = b64encode(json.dumps({
+        'signature': signer.sign(
+            session['state_validation']
+        ).split(':', 1)[1],
+        'next': None,
+    }).encode('utf-8')).decode()
+
+    request = factory.get(
+        reverse('oauth-callback', ('facebook', )) + '?' + urlencode({
+            'state': state,
+        })
+    )
+    request.session = session
+    request.user = AnonymousUser()
+    res = async_to_sync(views.callback_async)(request, provider='facebook')
+    assert res.status_code == HTTPStatus.OK
+    assert json.loads(res.content) == '456'
+    assert request.user.oauth_identities.filter(subject='456').exists()
+
+    res = async_to_sync(views.callback_async)(request, provider='facebook')
+    assert res.status_code == HTTPStatus.FORBIDDEN
+    assert json.loads(res.content)['detail'] == 'State is missing or invalid.'
+
+    res = async_to_sync(views.callback_async)(request, provider='surprise')
+    assert res.status_code == HTTPStatus.NOT_FOUND
+
+    request = factory.post(reverse('oauth-callback', ('facebook', )))
+    res = async_to_sync(views.callback_async)(request, provider='facebook')
+    assert res.status_code == HTTPStatus.METHOD_NOT_ALLOWED
+    assert res['Allow'] == 'GET, HEAD'
+    assert views.callback_async.csrf_exempt
+
+
+@pytest.mark.django_db
+def test_refresh_oauth_tokens(settings, monkeypatch, user):
+    settings.OAUTH = {
+        'facebook': {
+            'client_id': 'myclientid',
+            'client_secret': 'mysecret',
+            'token_uri': 'https://facebook.com/token',
+        }
+    }
+    settings.OAUTH_REFRESH_BATCH_SIZE = 2
+
+    def fake_token_refresh(url, data, headers):
+        res = lambda: None
+        res.status_code = HTTPStatus.OK
+        if data['refresh_token'] == 'revoked':
+            res.status_code = HTTPStatus.BAD_REQUEST
+        if data['refresh_token'] == 'throttled':
+            res.status_code = HTTPStatus.TOO_MANY_REQUESTS
+        if data['refresh_token'] == 'unavailable':
+            res.status_code = HTTPStatus.SERVICE_UNAVAILABLE
+        res.json = lambda: {'access_token': 'new', 'expires_in': 3600}
+        if data['refresh_token'] == 'odd':
+            res.json = lambda: {'access_token': 'new', 'expires_in': 'soon'}
+        if data['refresh_token'] == 'broken':
+            res.json = lambda: json.loads('<html>')
+        return res
+
+    mock_provider_requests(monkeypatch, fake_token_refresh)
+
+    soon = timezone.now() + timedelta(seconds=60)
+    later = timezone.now() + timedelta(days=1)
+    expiring, revoked, fresh, odd, broken, throttled, unavailable = [
+        OAuthIdentity.objects.create(
+            provider='facebook',
+            subject=subject,
+            user=user,
+            access_info={'access_token': 'old', 'refresh_token': refresh},
+            expires_at=expires_at,
+        )
+        for subject, refresh, expires_at in [
+            ('1', 'valid', soon),
+            ('2', 'revoked', soon),
+            ('3', 'valid', later),
+            ('4', 'odd', soon),
+            ('5', 'broken', soon),
+            ('6', 'throttled', soon),
+            ('7', 'unavailable', soon),
+        ]
+    ]
+
+    # Only one run at a time
+    cache.add('refresh-oauth-tokens', 'another run')
+    assert refresh_oauth_tokens() is None
+    cache.delete('refresh-oauth-tokens')
+
+    # Rows a login updates meanwhile are only written if refreshed
+    updated = []
+    bulk_update = OAuthIdentity.objects.bulk_update
+    monkeypatch.setattr(
+        OAuthIdentity.objects, 'bulk_update',
+        lambda objs, fields: updated.extend(objs) or bulk_update(objs, fields),
+    )
+    assert refresh_oauth_tokens() == 6
+    assert {identity.subject for identity in updated} == {'1', '2', '4'}
+
+    expiring.refresh_from_db()
+    assert expiring.access_info == {
+        'access_token': 'new',
+        'expires_in': 3600,
+        'refresh_token': 'valid',
+    }
+    assert expiring.expires_at > later - timedelta(hours=23)
+
+    revoked.refresh_from_db()
+    assert revoked.access_info['access_token'] == 'old'
+    assert revoked.expires_at is None
+
+    fresh.refresh_from_db()
+    assert fresh.access_info['access_token'] == 'old'
+
+    # Errors don't stop the rest of the batch from being saved
+    odd.refresh_from_db()
+    assert odd.access_info['access_token'] == 'new'
+    assert odd.expires_at is None
+
+    broken.refresh_from_db()
+    assert broken.access_info['access_token'] == 'old'
+    assert broken.expires_at == soon
+
+    # Provider errors are retried on the next run
+    for identity in [throttled, unavailable]:
+        identity.refresh_from_db()
+        assert identity.access_info['access_token'] == 'old'
+        assert identity.expires_at == soon
+
+
 @pytest.mark.django_db
 def test_oauth_callback_provider_not_found(client):
     res = client.get(reverse('oauth-callback', ('surprise', )))
@@ -534,3 +1119,200 @@ def test_activated_signal_admin(client, user, settings):
     user_activated.send(sender=None, user=user, request=None)
     user.refresh_from_db()
     assert user.is_superuser
+
+
+@pytest.mark.django_db
+def test_import_users(tmp_path, settings, monkeypatch):
+    settings.PASSWORD_HASHERS = [
+        'django.contrib.auth.hashers.MD5PasswordHasher',
+    ]
+    records = [
+        {'username': 'alice', 'email': 'a@a.a', 'password': 'secret'},
+        {'username': 'bob', 'password_hash': make_password('hashed')},
+        {'username': 'carol', 'is_verified': 'true'},
+    ]
+    path = tmp_path / 'users.jsonl'
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+    checkpoint = tmp_path / 'checkpoint.json'
+
+    def import_users():
+        call_command(
+            'importusers',
+            str(path),
+            '--batch-size=2',
+            '--processes=1',
+            f'--checkpoint={checkpoint}',
+            stdout=StringIO(),
+        )
+
+    import_users()
+    assert User.objects.get(username='alice').check_password('secret')
+    assert User.objects.get(username='bob').check_password('hashed')
+    assert not User.objects.get(username='carol').has_usable_password()
+    assert User.objects.get(username='carol').is_verified
+
+    # Resumes after the already imported records
+    with path.open('a') as file:
+        file.write(json.dumps({'username': 'dave'}) + '\n')
+    import_users()
+    assert User.objects.count() == 4
+
+    # Hashing in worker processes, skipping users that exist already
+    records = [
+        {'username': 'alice', 'password': 'secret'},
+        {'username': 'erin', 'password': 'secret'},
+        {'username': 'frank', 'password': 'secret'},
+    ]
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+    stdout = StringIO()
+    call_command(
+        'importusers',
+        str(path),
+        '--processes=2',
+        '--skip-existing',
+        stdout=stdout,
+    )
+    assert 'Imported 2 records, skipped 1 existing' in stdout.getvalue()
+    assert User.objects.get(username='frank').check_password('secret')
+
+    for record in [
+        {'username': 'user12345678'},
+        {'username': 'spam eggs'},
+        {'username': 'grace', 'password_hash': 'plaintext'},
+    ]:
+        path.write_text(json.dumps(record) + '\n')
+        with pytest.raises(CommandError):
+            call_command('importusers', str(path), stdout=StringIO())
+    assert User.objects.count() == 6
+
+    # Existing users are named unless skipped
+    records = [{'username': 'heidi'}, {'username': 'alice'}]
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+    with pytest.raises(CommandError, match='usernames after 0 records: alice'):
+        call_command('importusers', str(path), stdout=StringIO())
+    assert User.objects.count() == 6
+
+    # Users created after the check for existing ones are skipped too
+    bulk_create = User.objects.bulk_create
+
+    def create_meanwhile(users, **kwargs):
+        User.objects.create(username='heidi')
+        return bulk_create(users, **kwargs)
+
+    monkeypatch.setattr(User.objects, 'bulk_create', create_meanwhile)
+    records = [{'username': 'heidi'}, {'username': 'ivan'}]
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+    stdout = StringIO()
+    call_command(
+        'importusers', str(path), '--processes=1', '--skip-existing',
+        stdout=stdout,
+    )
+    assert 'Imported 1 records, skipped 1 existing' in stdout.getvalue()
+    assert User.objects.get(username='heidi').password == ''
+
+
+# Every endpoint of users.urls with its performance budget per successful
+# request, as (URL name, method, data or a function of the user making
+# it, logged in, budget), at the counts measured when last changed
+ENDPOINT_BUDGETS = [
+    ('rest_framework:login', 'get', None, False, {'queries': 0, 'cache': 0}),
+    ('rest_framework:logout', 'get', None, True, {'queries': 4, 'cache': 0}),
+    ('rest_registration:register', 'post', {
+        'username': 'bob',
+        'email': 'bob@example.com',
+        'password': 'Correct-horse-battery-staple',
+        'password_confirm': 'Correct-horse-battery-staple',
+    }, False, {'queries': 13, 'cache': 0}),
+    ('rest_registration:verify-registration', 'post', lambda user: (
+        RegisterSigner({'user_id': str(user.pk)}).get_signed_data()
+    ), False, {'queries': 11, 'cache': 0}),
+    ('rest_registration:send-reset-password-link', 'post', lambda user: {
+        'login': user.username,
+    }, False, {'queries': 1, 'cache': 0}),
+    ('rest_registration:reset-password', 'post', lambda user: {
+        **ResetPasswordSigner({'user_id': str(user.pk)}).get_signed_data(),
+        'password': 'Correct-horse-battery-staple',
+    }, False, {'queries': 3, 'cache': 0}),
+    ('rest_registration:login', 'post', lambda user: {
+        'login': user.username, 'password': 'secret',
+    }, False, {'queries': 9, 'cache': 0}),
+    ('rest_registration:logout', 'post', None, True, {
+        'queries': 4, 'cache': 0,
+    }),
+    ('rest_registration:profile', 'get', None, True, {
+        'queries': 2, 'cache': 0,
+    }),
+    ('rest_registration:change-password', 'post', {
+        'old_password': 'secret',
+        'password': 'Correct-horse-battery-staple',
+        'password_confirm': 'Correct-horse-battery-staple',
+    }, True, {'queries': 3, 'cache': 0}),
+    ('rest_registration:register-email', 'post', {
+        'email': 'new@example.com',
+    }, True, {'queries': 2, 'cache': 0}),
+    ('rest_registration:verify-email', 'post', lambda user: (
+        RegisterEmailSigner({
+            'user_id': str(user.pk), 'email': 'new@example.com',
+        }).get_signed_data()
+    ), True, {'queries': 4, 'cache': 0}),
+    ('auth-root', 'get', None, False, {'queries': 0, 'cache': 5}),
+    ('oauth', 'get', None, False, {'queries': 0, 'cache': 5}),
+    ('oauth-provider', 'get', None, False, {
+        'queries': 4, 'cache': 0, 'http': 0,
+    }),
+]
+# The OAuth callback needs a provider, its happy paths have their own tests
+BUDGETED_ELSEWHERE = {'oauth-callback'}
+
+
+def test_endpoint_budgets_cover_urls():
+    def names(patterns, namespace=''):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                yield from names(
+                    pattern.url_patterns,
+                    namespace + (f'{pattern.namespace}:' * bool(
+                        pattern.namespace
+                    )),
+                )
+            else:
+                yield namespace + pattern.name
+
+    budgeted = {name for name, *rest in ENDPOINT_BUDGETS}
+    assert set(names(get_resolver('users.urls').url_patterns)) == (
+        budgeted | BUDGETED_ELSEWHERE
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    'name,method,data,logged_in,limits', ENDPOINT_BUDGETS,
+    ids=[name for name, *rest in ENDPOINT_BUDGETS],
+)
+def test_endpoint_budgets(
+    request, client, settings, budget, user, name, method, data, logged_in,
+    limits,
+):
+    # Measure cold caches, and don't leave cached responses behind
+    cache.clear()
+    request.addfinalizer(cache.clear)
+    settings.OAUTH = {'google': {
+        'auth_uri': 'https://google.com/oauth',
+        'client_id': 'myclientid',
+        'client_secret': 'mysecret',
+        'scope': 'myscope',
+        'token_uri': 'https://google.com/token',
+    }}
+    user.email = 'user0@example.com'
+    user.is_verified = name != 'rest_registration:verify-registration'
+    user.set_password('secret')
+    user.save()
+    if logged_in:
+        client.force_login(user)
+    args = ('google', ) if name.startswith('oauth-') else ()
+    if callable(data):
+        data = data(user)
+
+    with budget(**limits):
+        response = getattr(client, method)(reverse(name, args), data)
+    assert response.status_code < HTTPStatus.BAD_REQUEST
@@ -1,8 +1,16 @@
 """URL Configuration for authentication and user management"""
 
+from django.conf import settings
 from django.urls import include, path
 
-from .views import auth, callback, oauth, provider
+from . import views
+from .views import auth, oauth
+
+# Under ASGI the async views let a worker wait on many providers at once
+if settings.OAUTH_ASYNC:
+    provider, callback = views.provider_async, views.callback_async
+else:
+    provider, callback = views.provider, views.callback
 
 urlpatterns = [
     path('api/auth/browsable/', include('rest_framework.urls')),
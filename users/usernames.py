@@ -0,0 +1,55 @@
+"""
+Collision-free usernames for users signing up with OAuth.
+
+Generated usernames are "user" followed by a number no other user can
+get: on PostgreSQL it comes from a database sequence, elsewhere each
+process reserves a block of numbers with a single `UsernameBlock` insert
+and hands them out from memory. The numbers start above the range of the
+random 7-digit usernames given out previously and past any existing
+generated-looking ones (see the 0009 migration), and people can't pick
+such usernames themselves (see `users.serializers`), so
+creating a user always takes exactly one INSERT.
+"""
+
+import threading
+
+from django.db import connections, router, transaction
+
+from .models import User, UsernameBlock
+
+SEQUENCE = 'users_username_seq'
+FIRST_NUMBER = 10 ** 7
+BLOCK_SIZE = 100
+
+_lock = threading.Lock()
+_blocks = {}
+
+
+def next_number(using):
+    if connections[using].vendor == 'postgresql':
+        with connections[using].cursor() as cursor:
+            cursor.execute('SELECT nextval(%s)', [SEQUENCE])
+            return cursor.fetchone()[0]
+
+    with _lock:
+        if _blocks.get(using):
+            return _blocks[using].pop()
+
+    reservation = UsernameBlock.objects.using(using).create()
+    start = FIRST_NUMBER + (reservation.pk - 1) * BLOCK_SIZE
+    block = list(reversed(range(start, start + BLOCK_SIZE)))
+    number = block.pop()
+
+    # A rolled back reservation can be made again by someone else, so
+    # only hand out the rest of the block once it's committed
+    def keep_block():
+        with _lock:
+            _blocks[using] = block + _blocks.get(using, [])
+
+    transaction.on_commit(keep_block, using=using)
+    return number
+
+
+def generate_username():
+    """Get the next unused username"""
+    return f'user{next_number(router.db_for_write(User))}'
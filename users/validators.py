@@ -0,0 +1,27 @@
+import re
+
+from django.core.exceptions import ValidationError
+from django.utils.translation import gettext_lazy as _
+
+# Usernames given to users signing up with OAuth, see `users.usernames`
+GENERATED_USERNAME = re.compile(r'user\d{8,}')
+
+
+def validate_not_generated_username(value):
+    """
+    Keep generated usernames for `users.usernames`, so that they can
+    never collide with usernames people choose:
+
+    >>> validate_not_generated_username('user1234567')
+    >>> validate_not_generated_username('user12345678')
+    Traceback (most recent call last):
+        ...
+    django.core.exceptions.ValidationError: ['Usernames like user12345678 \
+are reserved.']
+    """
+    if GENERATED_USERNAME.fullmatch(value):
+        raise ValidationError(
+            _('Usernames like %(value)s are reserved.'),
+            code='reserved',
+            params={'value': value},
+        )